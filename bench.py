@@ -0,0 +1,647 @@
+import argparse
+import ast
+import cache
+import copy
+import crawler
+import functools
+import http.server
+import json
+import metrics
+import random
+import ratecontrol
+import resource
+import shard
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import frontier
+import graphstore
+import url as urlmod
+import utils
+from collections import Counter
+from os import listdir, makedirs, path
+
+## helpers
+
+# returns (result, seconds, peak of allocated bytes) of func(*args)
+def measure(func, *args) -> (object, float, int):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (result, elapsed, peak)
+
+# peak resident set size of the process in bytes, since the last resetPeakRss
+def peakRss() -> int:
+    try:
+        with open("/proc/self/status", "r") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # not resettable, peak since the start of the process (kilobytes on Linux, bytes on macOS)
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxRss if sys.platform == "darwin" else maxRss * 1024
+
+def resetPeakRss() -> None:
+    try:
+        with open("/proc/self/clear_refs", "w") as clearRefs:
+            clearRefs.write("5")
+    except OSError:
+        pass
+
+# returns (result, seconds, peak resident set size in bytes) of func(*args), without the overhead of tracemalloc
+def measureRss(func, *args) -> (object, float, int):
+    resetPeakRss()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    return (result, elapsed, peakRss())
+
+# pages of the corpus directory, or synthetic pages with links, scripts and forms if no directory is given
+def loadCorpus(corpusDir: str = None, size: int = 50) -> []:
+    if corpusDir != None:
+        pages = []
+        for filename in sorted(listdir(corpusDir)):
+            with open(path.join(corpusDir, filename), "r", errors="replace") as page:
+                pages.append(page.read())
+        return pages
+    return ["<html><body>" + "".join('<div><a href="/p' + str(j) + '.html?id=' + str(i) + '">link</a><p>' + "lorem ipsum " * 20 + '</p></div>' for j in range(200)) + '<script src="/main.js"></script><form action="/search" method="post"><input name="q" value=""><input name="page" value="1"></form></body></html>' for i in range(size)]
+
+# the BeautifulSoup extraction used before url.LinkExtractor, as a reference
+def findReqsSoup(page: str, refUrl: urlmod.URL) -> []:
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(page, features="html.parser")
+    rets = []
+    for a in soup.find_all('a'):
+        if a.get('href') == None: continue
+        aUrl = urlmod.URL(a.get('href'), refUrl=refUrl)
+        rets.append((a.get('href'), {"page": aUrl.page, "params": aUrl.params, "method": "GET", "edgeSize": 2}))
+    for script in soup.find_all('script'):
+        if script.get('src') == None: continue
+        rets.append((script.get('src'), {"page": urlmod.URL(script.get('src'), refUrl=refUrl).page, "params": [" "], "method": "GET", "edgeSize": 2}))
+    for form in soup.find_all('form'):
+        if form.get('action') == None: continue
+        method = "GET" if form.get('method') == None else form.get('method').upper()
+        params = [str(inp.get('name'))+"="+str(inp.get("value")) for inp in form.find_all('input')]
+        rets.append((form.get('action'), {"page": urlmod.URL(form.get('action'), refUrl=refUrl).page, "params": [" "] if params == [] else params, "method": method, "edgeSize": 2}))
+    return utils.computeLinkSize(rets)
+
+# the quadratic edge aggregations used before utils.edgeKey, as references
+def computeLinkSizeReference(urlsAndLinks: []) -> []:
+    for index, urlAndLink1 in enumerate(urlsAndLinks):
+        size = urlsAndLinks.count(urlAndLink1)
+        if size > 1:
+            for urlAndLink2 in urlsAndLinks:
+                if urlAndLink1[1]["page"] == urlAndLink2[1]["page"] and urlAndLink1[1]["method"] == urlAndLink2[1]["method"] and sorted(urlAndLink1[1]["params"]) == sorted(urlAndLink2[1]["params"]):
+                    urlsAndLinks.remove(urlAndLink2)
+        urlsAndLinks[index][1]["edgeSize"] = size+1
+    return urlsAndLinks
+
+def computeGlobalLinkSizeReference(graph: {}) -> {}:
+    for page, attributes in graph.items():
+        links = attributes["links"]
+        newLinks = []
+        alreadyAddedLinks = []
+        for link1 in links:
+            if (link1["page"], sorted(link1["params"]), link1["method"]) in alreadyAddedLinks:
+                continue
+            size = link1["edgeSize"]
+            for link2 in links:
+                if link1["page"] == link2["page"] and link1["method"] == link2["method"] and sorted(link1["params"]) == sorted(link2["params"]):
+                        size += link2["edgeSize"] - 1
+            alreadyAddedLinks.append((link1["page"], sorted(link1["params"]), link1["method"]))
+            newLinks.append({"page": link1["page"], "params": link1["params"], "method": link1["method"], "edgeSize": size})
+        graph[page]["links"] = newLinks
+    return graph
+
+# links of a page as found by the extraction: each distinct link appears once, or several times in a row with the same href
+# (the only duplicates the former aggregation sized right, see edgeCases for the others)
+def makeUrlsAndLinks(size: int) -> []:
+    urlsAndLinks = []
+    for i in range(size):
+        for repeat in range(1 + i % 3):
+            urlsAndLinks.append(("/p" + str(i) + "?b=1&a=" + str(i % 5), {"page": "example.com/p" + str(i) + "/", "params": ["b=1", "a=" + str(i % 5)], "method": "GET" if i % 4 else "POST", "edgeSize": 2}))
+    return urlsAndLinks
+
+# graph whose pages link several times to the same edges, params in different orders
+def makeGraph(pages: int, linksPerPage: int) -> {}:
+    graph = {}
+    for i in range(pages):
+        links = []
+        for j in range(linksPerPage):
+            params = ["a=" + str(j % 7), "b=" + str(j % 3)]
+            links.append({"page": "example.com/p" + str(j % (linksPerPage // 2 + 1)) + "/", "params": params if j % 2 else params[::-1], "method": "GET" if j % 5 else "POST", "edgeSize": 2 + j % 4})
+        graph["example.com/p" + str(i) + "/"] = {"links": links, "outOfScopeURLs": [], "internal": {"nodeSize": 1}}
+    return graph
+
+# the URL construction used before url.canonicalize (decodes twice, builds the page three times), as a reference:
+# URL.__init__ of the former url.py and the helpers of the former utils.py it called, copied as they were
+def canonicalizeReference(href: str, refUrl: urlmod.URL) -> (str, str, str, str, []):
+    import re
+    from urllib.parse import unquote
+
+    def matchScheme(url: str) -> str:
+        return re.match("^((http|https):)?//", url)
+
+    def addScheme(string: str) -> str:
+        return string if matchScheme(string) != None else "https://"+string
+
+    def removeStartSlash(url: str) -> str:
+        return re.sub("^/+", "", url)
+
+    def removeLastSpecialChar(string: str) -> str:
+        return string[:-1] if string[-1] in "/#?" else string
+
+    def removeDots(string: str) -> str:
+        parts = string.split("/")
+        for i in range(parts.count("..")):
+            parts.remove(parts[parts.index("..")-1])
+            parts.remove(parts[parts.index("..")])
+        for i in range(parts.count(".")):
+            parts.remove(parts[parts.index(".")])
+        return "/".join(parts)
+
+    def isFile(url: str) -> bool:
+        urlParts = url.split('/')
+        if len(urlParts) >= 2:
+            return '.' in urlParts[-1]
+        return False
+
+    def constructPage(url: str) -> str:
+        url = re.sub("^((http|https)://)", "", url).split("#")[0].split("?")[0]
+        url = removeDots(url)
+        return url + ("" if (isFile(url) or url[-1] == "/") else "/")
+
+    def constructHostname(url: str) -> str:
+        return constructPage(url).split('/')[0]
+
+    def constructDomain(url: str) -> str:
+        parts = constructHostname(url).split('.')
+        return '.'.join(parts[1:]) if len(parts) > 2 else '.'.join(parts)
+
+    def constructParams(url: str) -> []:
+        parts = url.split('?')
+        return [" "] if len(parts) == 1 else parts[1].split('&')
+
+    def normalize(url: str, ref, isRef: bool) -> str:
+        url = unquote(url)
+        url = removeLastSpecialChar(url)
+        if isRef:
+            return addScheme(url)
+        else:
+            if matchScheme(url) == None:
+                if url.startswith(ref.hostname):
+                    return addScheme(removeStartSlash(url))
+                else:
+                    return addScheme(ref.hostname+"/"+removeStartSlash(url))
+            elif url.startswith("//"):
+                return addScheme(url[2:])
+            else:
+                return url
+
+    url = normalize(unquote(href), refUrl, False)
+    return (url, constructPage(url), constructHostname(url), constructDomain(url), constructParams(url))
+
+# hrefs whose canonicalization is checked against the reference besides the ones of makeHrefs: scheme-relative, encoded, dotted
+checkedHrefs = ["//cdn.example.org/a.js", "////cdn.example.org/a", "//http://cdn.example.org/", "%2F%2Fcdn.example.org/b?x=1", "/a%2520b/", "www.example.com/blog/../x?y=1#z", "http://example.org/./a/../b/", "?q=1", "#top"]
+
+# hrefs as found on the pages of a site: navigation links repeat on every page, content links are mostly unique
+def makeHrefs(size: int) -> []:
+    hrefs = []
+    for i in range(size):
+        if i % 4 == 0:
+            hrefs.append("/section" + str(i % 40) + "/")
+        elif i % 4 == 1:
+            hrefs.append("../articles/./" + str(i % (size // 20 + 1)) + "-title.html?ref=nav&page=" + str(i % 7))
+        elif i % 4 == 2:
+            hrefs.append("https://www.example.com/products/item%20" + str(i % (size // 10 + 1)) + "?color=red#reviews")
+        else:
+            hrefs.append("//cdn.example.org/static/app" + str(i % 50) + ".js")
+    return hrefs
+
+## synthetic website
+
+# writes a website in siteDir, served at baseUrl (eg. "http://127.0.0.1:8000/"), and returns {url: page code} of its HTML pages
+# pages form a tree of the given fan-out and depth, each page also links to fanOut random pages and every link is repeated duplicates times,
+# pages are padded to pageSize characters, and have forms posting to search pages and links to binary assets
+def makeSite(siteDir: str, baseUrl: str, fanOut: int = 5, depth: int = 3, pageSize: int = 10000, forms: int = 1, duplicates: int = 2, assets: int = 2, seed: int = 0) -> {}:
+    rnd = random.Random(seed)
+    # pages of each depth, index.html is the root
+    levels = [["index.html"]]
+    for level in range(1, depth + 1):
+        levels.append(["d" + str(level) + "/p" + str(index) + ".html" for index in range(len(levels[-1]) * fanOut)])
+    allPages = [page for level in levels for page in level]
+    assetNames = ["assets/image" + str(index) + (".png" if index % 2 == 0 else ".zip") for index in range(assets)]
+
+    for directory in {path.dirname(page) for page in allPages + assetNames} - {""}:
+        makedirs(path.join(siteDir, directory), exist_ok=True)
+    for assetName in assetNames:
+        with open(path.join(siteDir, assetName), "wb") as asset:
+            asset.write(rnd.randbytes(4096))
+
+    pageCodes = {}
+    for level, pages in enumerate(levels):
+        for index, page in enumerate(pages):
+            children = levels[level + 1][index * fanOut:(index + 1) * fanOut] if level < depth else []
+            targets = children + [rnd.choice(allPages) for link in range(fanOut)]
+            body = "".join('<li><a href="' + baseUrl + target + '">' + target + '</a></li>' for target in targets for duplicate in range(duplicates))
+            body += "".join('<a href="' + baseUrl + assetName + '">' + assetName + '</a>' for assetName in assetNames)
+            body += "".join('<form action="' + baseUrl + 'search' + str(form) + '.html" method="post"><input name="q" value=""><input name="page" value="' + str(index) + '"></form>' for form in range(forms))
+            body += '<script src="' + baseUrl + 'main.js"></script>'
+            padding = max(pageSize - len(body) - 80, 0)
+            pageCode = "<html><head><title>" + page + "</title></head><body><ul>" + body + "</ul><p>" + ("lorem ipsum " * (padding // 12 + 1))[:padding] + "</p></body></html>"
+            with open(path.join(siteDir, page), "w") as pageFile:
+                pageFile.write(pageCode)
+            pageCodes[baseUrl + page] = pageCode
+    for form in range(forms):
+        with open(path.join(siteDir, "search" + str(form) + ".html"), "w") as searchPage:
+            searchPage.write("<html><body>results</body></html>")
+    with open(path.join(siteDir, "main.js"), "w") as script:
+        script.write("var main;")
+    return pageCodes
+
+class SiteHandler(http.server.SimpleHTTPRequestHandler):
+    """Class that serves the synthetic website with keep-alive connections and counts the served HTML pages"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        super().do_GET()
+        if self.path.endswith(".html"):
+            with self.server.lock:
+                self.server.servedPages += 1
+
+    def log_message(self, *args) -> None:
+        pass
+
+class ThrottlingHandler(SiteHandler):
+    """Class that serves the synthetic website, and answers 429 with a Retry-After header beyond server.maxInFlight requests at once"""
+
+    def do_GET(self) -> None:
+        with self.server.lock:
+            self.server.inFlight += 1
+            throttled = self.server.inFlight > self.server.maxInFlight
+            if throttled:
+                self.server.throttledRequests += 1
+        try:
+            if throttled:
+                self.send_response(429)
+                self.send_header("Retry-After", str(self.server.retryAfter))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                # a slow page, so that the concurrent requests overlap
+                time.sleep(self.server.latency)
+                super().do_GET()
+        finally:
+            with self.server.lock:
+                self.server.inFlight -= 1
+
+# serves siteDir on a free local port in a background thread
+def serveSite(siteDir: str, handler: type = SiteHandler) -> http.server.ThreadingHTTPServer:
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(handler, directory=siteDir))
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.servedPages = 0
+    # throttling of ThrottlingHandler
+    server.inFlight = 0
+    server.maxInFlight = 4
+    server.retryAfter = 0.1
+    server.latency = 0.01
+    server.throttledRequests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# runs sidemap.main() on the served website, with the graph built but not displayed, or headless (--no-display)
+# with the graph only written in outputFile
+def benchMain(server: http.server.ThreadingHTTPServer, baseUrl: str, depth: int, workers: int = 1, parsers: int = 0, shards: int = 0, shardDir: str = None, display: bool = True, outputFile: str = None) -> {}:
+    import sidemap
+    displayed = {}
+
+    def noDisplay(graph, *args) -> None:
+        displayed["nodes"] = graph.number_of_nodes()
+        displayed["edges"] = graph.number_of_edges()
+
+    argv, drawGravis = sys.argv, utils.drawGravis
+    sys.argv = ["sidemap.py", "-u", baseUrl + "index.html", "-d", str(depth), "-w", str(workers), "-p", str(parsers), "-sh", str(shards)] + (["-sd", shardDir] if shardDir != None else []) + (["-o", outputFile] if outputFile != None else []) + ([] if display else ["--no-display"])
+    utils.drawGravis = noDisplay
+    server.servedPages = 0
+    metrics.registry.reset()
+    try:
+        result, elapsed, peak = measureRss(sidemap.main)
+    finally:
+        sys.argv, utils.drawGravis = argv, drawGravis
+    # nodes and edges of the written graph
+    if not(display):
+        with open(outputFile, "r") as records:
+            types = Counter(json.loads(record).get("type") for record in records)
+        displayed = {"nodes": types["node"], "edges": types["edge"]}
+    return {"stage": "main", "display": display, "workers": workers, "parsers": parsers, "shards": shards, "pages": server.servedPages, "nodes": displayed["nodes"], "edges": displayed["edges"], "seconds": elapsed, "pagesPerSecond": server.servedPages / elapsed, "peakRssBytes": peak, "transferredBytes": metrics.registry.total("sidemap_transferred_bytes_total"), "pageBytes": metrics.registry.total("sidemap_response_bytes"), "skippedResponses": metrics.registry.total("sidemap_skipped_pages_total")}
+
+# runs the stages of sidemap one after the other on the served website
+def benchStages(server: http.server.ThreadingHTTPServer, baseUrl: str, depth: int, pageCodes: {}) -> [{}]:
+    rets = []
+    refUrls = {pageUrl: urlmod.URL(pageUrl, isRef=True) for pageUrl in pageCodes}
+
+    def findAllReqs() -> int:
+        return sum(len(urlmod.findReqs(pageCode, refUrls[pageUrl])) for pageUrl, pageCode in pageCodes.items())
+
+    links, elapsed, peak = measureRss(findAllReqs)
+    rets.append({"stage": "findReqs", "pages": len(pageCodes), "links": links, "seconds": elapsed, "pagesPerSecond": len(pageCodes) / elapsed, "megabytesPerSecond": sum(len(pageCode) for pageCode in pageCodes.values()) / elapsed / 1e6, "peakRssBytes": peak})
+
+    rootUrl = urlmod.URL(baseUrl + "index.html", isRef=True)
+    graph = graphstore.GraphStore.fromDict({"recap": {"links": [], "outOfScopeURLs": [], "internal": {"nodeSize": 10}}, rootUrl.page: {"links": [], "outOfScopeURLs": [], "internal": {"nodeSize": 2}}})
+    server.servedPages = 0
+    graph, elapsed, peak = measureRss(crawler.crawl, graph, rootUrl, depth, ["png", "jpg", "jpeg", "ico", "svg"])
+    rets.append({"stage": "crawl", "pages": server.servedPages, "nodes": len(graph), "seconds": elapsed, "pagesPerSecond": server.servedPages / elapsed, "peakRssBytes": peak})
+
+    graph = graph.toDict()
+    for name, func in [("computeGlobalLinkSize", utils.computeGlobalLinkSize), ("colorNodes", utils.colorNodes), ("colorEdges", lambda graph: utils.colorEdges(graph, rootUrl.page)), ("makeNXGraph", utils.makeNXGraph)]:
+        result, elapsed, peak = measureRss(func, graph)
+        rets.append({"stage": name, "nodes": len(graph), "edges": sum(len(attributes["links"]) for attributes in graph.values()), "seconds": elapsed, "peakRssBytes": peak})
+        if isinstance(result, dict):
+            graph = result
+    return rets
+
+# crawls the website served by ThrottlingHandler without then with its limit, the graphs must be the same
+def benchThrottle(server: http.server.ThreadingHTTPServer, baseUrl: str, depth: int, workers: int, maxInFlight: int) -> [{}]:
+    rets = []
+    rootUrl = urlmod.URL(baseUrl + "index.html", isRef=True)
+    host = baseUrl.split("/")[2]
+    graphs = []
+    for limit in [workers, maxInFlight]:
+        ratecontrol.controller = ratecontrol.RateController(maxConcurrency=workers, retries=8)
+        graph = graphstore.GraphStore.fromDict({"recap": {"links": [], "outOfScopeURLs": [], "internal": {"nodeSize": 10}}, rootUrl.page: {"links": [], "outOfScopeURLs": [], "internal": {"nodeSize": 2}}})
+        server.maxInFlight, server.servedPages, server.throttledRequests = limit, 0, 0
+        graph, elapsed, peak = measureRss(crawler.crawlConcurrent, graph, rootUrl, depth, ["png", "jpg", "jpeg", "ico", "svg"], [], False, workers)
+        graphs.append(graph.toDict())
+        rate = ratecontrol.controller.rates()[host]
+        rets.append({"stage": "throttle", "workers": workers, "maxInFlight": limit, "pages": server.servedPages, "nodes": len(graph), "throttled": server.throttledRequests, "retries": rate["retries"], "concurrency": rate["concurrency"], "seconds": elapsed, "pagesPerSecond": server.servedPages / elapsed, "sameGraph": graphs[-1] == graphs[0]})
+    return rets
+
+# crawls the served website with crawler.crawl then sharded between shards worker processes, the graphs must be the same
+def benchShards(server: http.server.ThreadingHTTPServer, baseUrl: str, depth: int, workers: int, shards: int, shardDir: str) -> [{}]:
+    rets = []
+    rootUrl = urlmod.URL(baseUrl + "index.html", isRef=True)
+    graphs = []
+    for engineShards in [0, shards]:
+        graph = graphstore.GraphStore.fromDict({"recap": {"links": [], "outOfScopeURLs": [], "internal": {"nodeSize": 10}}, rootUrl.page: {"links": [], "outOfScopeURLs": [], "internal": {"nodeSize": 2}}})
+        server.servedPages = 0
+        if engineShards == 0:
+            graph, elapsed, peak = measureRss(crawler.crawl, graph, rootUrl, depth, ["png", "jpg", "jpeg", "ico", "svg"])
+        else:
+            graph, elapsed, peak = measureRss(shard.crawlSharded, graph, rootUrl, depth, ["png", "jpg", "jpeg", "ico", "svg"], [], False, workers, [], engineShards, shardDir)
+        graphs.append(graph.toDict())
+        rets.append({"stage": "shards", "shards": engineShards, "workers": workers, "pages": server.servedPages, "nodes": len(graph), "seconds": elapsed, "pagesPerSecond": server.servedPages / elapsed, "sameGraph": graphs[-1] == graphs[0]})
+    return rets
+
+
+## stages
+
+# queues every URL twice (as pages are usually linked several times) then visits the frontier
+def benchFrontier(size: int) -> {}:
+    urls = [urlmod.URL("https://example.com/page" + str(i) + "/?id=" + str(i), isRef=True) for i in range(size)]
+    start = time.perf_counter()
+    toVisitUrls = frontier.Frontier(urls[0])
+    visited = 0
+    for url in toVisitUrls:
+        visited += 1
+        if visited == 1:
+            for foundUrl in urls + urls:
+                toVisitUrls.add(foundUrl)
+    elapsed = time.perf_counter() - start
+    return {"stage": "frontier", "size": size, "seconds": elapsed, "microsecondsPerUrl": 1e6 * elapsed / size}
+
+# extracts the requests of every page of the corpus with the given extractor
+def benchExtract(pages: [], extractor: str = "stream") -> {}:
+    findReqs = urlmod.findReqs if extractor == "stream" else findReqsSoup
+    refUrl = urlmod.URL("https://example.com/", isRef=True)
+
+    def extractAll() -> int:
+        return sum(len(findReqs(page, refUrl)) for page in pages)
+
+    links, elapsed, peak = measure(extractAll)
+    size = sum(len(page) for page in pages)
+    return {"stage": "extract", "extractor": extractor, "pages": len(pages), "links": links, "seconds": elapsed, "pagesPerSecond": len(pages) / elapsed, "megabytesPerSecond": size / elapsed / 1e6, "peakBytes": peak}
+
+# yields (page, links, out of scope page) of a synthetic crawl of size pages
+def syntheticPages(size: int, linksPerPage: int = 4):
+    for i in range(size):
+        page = "example.com/section" + str(i % 100) + "/page" + str(i) + "/"
+        links = [{"page": "example.com/section" + str((i * 7 + j) % size % 100) + "/page" + str((i * 7 + j) % size) + "/", "params": ["id=" + str(j)], "method": "GET" if j else "POST", "edgeSize": 2} for j in range(linksPerPage)]
+        yield (page, links, "cdn.example.org/asset" + str(i % 1000) + ".png")
+
+# builds a synthetic crawl graph of size nodes, as a dict of dicts or as a GraphStore, and returns its retained memory
+def benchGraph(size: int, backend: str = "store", linksPerPage: int = 4) -> {}:
+
+    def build() -> object:
+        graph = graphstore.GraphStore() if backend == "store" else {}
+        for page, links, outOfScopePage in syntheticPages(size, linksPerPage):
+            if backend == "store":
+                graph.addNode(page)
+                for link in links:
+                    graph.addLink(page, link)
+                graph.addOutOfScopeURL(page, outOfScopePage)
+            else:
+                graph[page] = {"links": links, "outOfScopeURLs": [outOfScopePage], "internal": {"nodeSize": 1}}
+        return graph
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    graph = build()
+    elapsed = time.perf_counter() - start
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {"stage": "graph", "backend": backend, "nodes": size, "edges": size * linksPerPage, "seconds": elapsed, "retainedBytes": retained, "bytesPerNode": retained / size}
+
+# loads the same synthetic graph from a cache file of the current format and of the former one (python literal)
+def benchCache(size: int, cacheDir: str) -> [{}]:
+    graph = {page: {"links": links, "outOfScopeURLs": [outOfScopePage], "internal": {"nodeSize": 1}} for page, links, outOfScopePage in syntheticPages(size)}
+    name = "bench" + str(size)
+    with open(path.join(cacheDir, name + ".cache"), "w") as cf:
+        cf.write(str(graph))
+    cache.save(graph, path.join(cacheDir, name + ".jsonl"))
+
+    def loadLiteral() -> {}:
+        with open(path.join(cacheDir, name + ".cache"), "r") as cf:
+            return ast.literal_eval(cf.read())
+
+    rets = []
+    for cacheFormat, load in [("jsonl", lambda: cache.load(cacheDir, name)), ("literal", loadLiteral)]:
+        loaded, elapsed, peak = measure(load)
+        rets.append({"stage": "cache", "format": cacheFormat, "nodes": size, "seconds": elapsed, "peakBytes": peak, "identical": loaded == graph})
+    return rets
+
+# canonicalizes the hrefs with the former multi-pass construction, the single-pass one without memoization and the memoized one
+def benchUrls(size: int) -> [{}]:
+    hrefs = makeHrefs(size)
+    refUrl = urlmod.URL("https://www.example.com/blog/", isRef=True)
+    rets = []
+    for method, canonicalize in [("reference", lambda href: canonicalizeReference(href, refUrl)), ("singlePass", lambda href: urlmod.canonicalize.__wrapped__(href, refUrl.hostname, False)), ("memoized", lambda href: urlmod.canonicalize(href, refUrl.hostname, False))]:
+        urlmod.canonicalize.cache_clear()
+        start = time.perf_counter()
+        for href in hrefs:
+            canonicalize(href)
+        elapsed = time.perf_counter() - start
+        rets.append({"stage": "urls", "method": method, "hrefs": size, "distinctHrefs": len(set(hrefs)), "seconds": elapsed, "hrefsPerSecond": size / elapsed})
+    # same URLs as before, raises AssertionError otherwise
+    for href in sorted(set(hrefs)) + checkedHrefs:
+        url, page, hostname, domain, params = urlmod.canonicalize(href, refUrl.hostname, False)
+        if (url, page, hostname, domain, list(params)) != canonicalizeReference(href, refUrl):
+            raise AssertionError("Canonicalization of " + href + " differs from the former one: " + str(canonicalizeReference(href, refUrl)) + " became " + str((url, page, hostname, domain, list(params))))
+    rets.append({"stage": "urls", "method": "check", "hrefs": len(set(hrefs)) + len(checkedHrefs), "identical": True})
+    return rets
+
+# links of a page whose aggregation changed with utils.edgeKey, as [(case, urlsAndLinks, edgeSizes of computeLinkSize,
+# edgeSizes of computeGlobalLinkSize after it, edgeSizes of the former computeLinkSize)]: duplicates are merged wherever they are
+# on the page and whatever the spelling of their href, a link found twice is always one edge of size 3 (5 once global)
+def edgeCases() -> []:
+
+    def link(href: str, page: str, params: []) -> (str, {}):
+        return (href, {"page": page, "params": params, "method": "GET", "edgeSize": 2})
+
+    return [
+        # the former aggregation dropped /b
+        ("notAdjacent", [link("/a", "example.com/a/", [" "]), link("/b", "example.com/b/", [" "]), link("/a", "example.com/a/", [" "])], [3, 2], [5, 3], [3]),
+        # the former aggregation kept two edges of size 2, 4 once global
+        ("paramsOrder", [link("/a?x=1&y=2", "example.com/a/", ["x=1", "y=2"]), link("/a?y=2&x=1", "example.com/a/", ["y=2", "x=1"])], [3], [5], [2, 2]),
+        ("sameHref", [link("/a", "example.com/a/", [" "]), link("/a", "example.com/a/", [" "])], [3], [5], [3]),
+    ]
+
+# compares the edge aggregations to their references on the same inputs, and checks the cases where they differ on purpose,
+# raises AssertionError on a mismatch
+def benchEdges(linksPerPage: int, pages: int = 10) -> [{}]:
+    rets = []
+    for name, func, reference, make in [("computeLinkSize", utils.computeLinkSize, computeLinkSizeReference, lambda: makeUrlsAndLinks(linksPerPage)), ("computeGlobalLinkSize", utils.computeGlobalLinkSize, computeGlobalLinkSizeReference, lambda: makeGraph(pages, linksPerPage))]:
+        result, elapsed, peak = measure(func, make())
+        referenceResult, referenceElapsed, referencePeak = measure(reference, make())
+        if result != referenceResult:
+            raise AssertionError(name + " differs from the former aggregation with " + str(linksPerPage) + " links per page")
+        rets.append({"stage": name, "links": linksPerPage, "seconds": elapsed, "referenceSeconds": referenceElapsed, "identical": True})
+
+    for case, urlsAndLinks, linkSizes, globalSizes, referenceSizes in edgeCases():
+        links = utils.computeLinkSize(copy.deepcopy(urlsAndLinks))
+        found = ([link["edgeSize"] for url, link in links], [link["edgeSize"] for link in utils.globalLinks([link for url, link in links])], [link["edgeSize"] for url, link in computeLinkSizeReference(copy.deepcopy(urlsAndLinks))])
+        if found != (linkSizes, globalSizes, referenceSizes):
+            raise AssertionError("Edge case " + case + ": expected " + str((linkSizes, globalSizes, referenceSizes)) + ", found " + str(found))
+        rets.append({"stage": "edgeCase", "case": case, "edgeSizes": linkSizes, "globalEdgeSizes": globalSizes, "formerEdgeSizes": referenceSizes})
+    return rets
+
+# lays out a synthetic crawl graph as a tree with the native layout or with graphviz dot (needs pygraphviz)
+def benchLayout(size: int, layout: str = "native") -> {}:
+    graph = utils.nx.MultiDiGraph()
+    graph.add_edges_from((page, link["page"]) for page, links, outOfScopePage in syntheticPages(size) for link in links)
+    root = next(iter(graph))
+    if layout == "dot":
+        try:
+            from networkx.drawing.nx_agraph import graphviz_layout
+            import pygraphviz
+        except ImportError:
+            # pygraphviz is optional, only this comparison needs it
+            return {"stage": "layout", "layout": layout, "nodes": graph.number_of_nodes(), "edges": graph.number_of_edges(), "available": False, "reason": "pygraphviz is not installed: install graphviz with its headers (eg. apt install graphviz graphviz-dev) then pip install pygraphviz"}
+        func = lambda: graphviz_layout(graph, prog='dot')
+    else:
+        func = lambda: utils.treeLayout(graph, root)
+    pos, elapsed, peak = measure(func)
+    return {"stage": "layout", "layout": layout, "nodes": graph.number_of_nodes(), "edges": graph.number_of_edges(), "available": True, "seconds": elapsed, "peakBytes": peak}
+
+## main
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="stage", required=True)
+    frontierParser = subparsers.add_parser("frontier", help="frontier scaling with the number of URLs")
+    frontierParser.add_argument("-s", "--sizes", default=[1000, 10000, 50000, 100000], help="numbers of synthetic URLs", nargs='+')
+    extractParser = subparsers.add_parser("extract", help="link extraction throughput and peak memory")
+    extractParser.add_argument("-co", "--corpus", default=None, help="directory of saved pages (synthetic pages by default)")
+    extractParser.add_argument("-e", "--extractors", default=["stream", "soup"], help="extractors to compare (stream, soup)", nargs='+')
+    edgesParser = subparsers.add_parser("edges", help="edge aggregation against the former quadratic one")
+    edgesParser.add_argument("-s", "--sizes", default=[100, 1000, 3000], help="numbers of links per page", nargs='+')
+    graphParser = subparsers.add_parser("graph", help="memory of the graph as dicts or as a GraphStore")
+    graphParser.add_argument("-s", "--sizes", default=[100000, 1000000], help="numbers of synthetic nodes", nargs='+')
+    graphParser.add_argument("-b", "--backends", default=["store", "dict"], help="graph backends to compare (store, dict)", nargs='+')
+    cacheParser = subparsers.add_parser("cache", help="cache file load time against the former literal_eval one")
+    cacheParser.add_argument("-s", "--sizes", default=[10000, 50000], help="numbers of synthetic nodes", nargs='+')
+    urlsParser = subparsers.add_parser("urls", help="URL canonicalization throughput")
+    urlsParser.add_argument("-s", "--sizes", default=[1000000], help="numbers of hrefs", nargs='+')
+    layoutParser = subparsers.add_parser("layout", help="tree layout time against graphviz dot")
+    layoutParser.add_argument("-s", "--sizes", default=[1000, 10000, 100000], help="numbers of synthetic nodes", nargs='+')
+    layoutParser.add_argument("-l", "--layouts", default=["native", "dot"], help="layouts to compare (native, dot)", nargs='+')
+    siteParser = subparsers.add_parser("site", help="end to end run and stages of sidemap on a synthetic local website")
+    siteParser.add_argument("-f", "--fan-out", default=5, help="children of each page, and random links on each page")
+    siteParser.add_argument("-d", "--depth", default=3, help="depth of the tree of pages")
+    siteParser.add_argument("-ps", "--page-size", default=10000, help="characters of each page")
+    siteParser.add_argument("-fo", "--forms", default=1, help="forms on each page")
+    siteParser.add_argument("-du", "--duplicates", default=2, help="occurrences of each link on a page")
+    siteParser.add_argument("-a", "--assets", default=2, help="binary files linked by each page")
+    siteParser.add_argument("-w", "--workers", default=1, help="workers of the end to end run")
+    siteParser.add_argument("-p", "--parsers", default=0, help="parsers of the end to end run")
+    siteParser.add_argument("-sh", "--shards", default=0, help="shards of the end to end run")
+    throttleParser = subparsers.add_parser("throttle", help="concurrent crawl of a synthetic local website answering 429 beyond some requests at once")
+    throttleParser.add_argument("-f", "--fan-out", default=5, help="children of each page, and random links on each page")
+    throttleParser.add_argument("-d", "--depth", default=3, help="depth of the tree of pages")
+    throttleParser.add_argument("-w", "--workers", default=16, help="workers of the crawl")
+    throttleParser.add_argument("-m", "--max-in-flight", default=4, help="requests served at once before answering 429")
+    args = parser.parse_args()
+
+    # one JSON record per line
+    if args.stage == "frontier":
+        for size in args.sizes:
+            print(json.dumps(benchFrontier(int(size))))
+    elif args.stage == "extract":
+        pages = loadCorpus(args.corpus)
+        for extractor in args.extractors:
+            print(json.dumps(benchExtract(pages, extractor)))
+    elif args.stage == "graph":
+        for size in args.sizes:
+            for backend in args.backends:
+                print(json.dumps(benchGraph(int(size), backend)))
+    elif args.stage == "cache":
+        with tempfile.TemporaryDirectory() as cacheDir:
+            for size in args.sizes:
+                for record in benchCache(int(size), cacheDir):
+                    print(json.dumps(record))
+    elif args.stage == "urls":
+        for size in args.sizes:
+            for record in benchUrls(int(size)):
+                print(json.dumps(record))
+    elif args.stage == "edges":
+        for size in args.sizes:
+            for record in benchEdges(int(size)):
+                print(json.dumps(record))
+    elif args.stage == "site":
+        with tempfile.TemporaryDirectory() as siteDir:
+            server = serveSite(siteDir)
+            baseUrl = "http://127.0.0.1:" + str(server.server_address[1]) + "/"
+            pageCodes = makeSite(siteDir, baseUrl, int(args.fan_out), int(args.depth), int(args.page_size), int(args.forms), int(args.duplicates), int(args.assets))
+            print(json.dumps({"stage": "site", "pages": len(pageCodes), "fanOut": int(args.fan_out), "depth": int(args.depth), "pageSize": int(args.page_size), "forms": int(args.forms), "duplicates": int(args.duplicates), "assets": int(args.assets)}))
+            # one more hop than the depth of the tree, to visit its leaves, headless then with the graph built for display
+            print(json.dumps(benchMain(server, baseUrl, int(args.depth) + 2, int(args.workers), int(args.parsers), int(args.shards), path.join(siteDir, "shards"), False, path.join(siteDir, "graph.jsonl"))))
+            print(json.dumps(benchMain(server, baseUrl, int(args.depth) + 2, int(args.workers), int(args.parsers), int(args.shards), path.join(siteDir, "shards"))))
+            for record in benchStages(server, baseUrl, int(args.depth) + 2, pageCodes):
+                print(json.dumps(record))
+            if int(args.shards) > 0:
+                for record in benchShards(server, baseUrl, int(args.depth) + 2, int(args.workers), int(args.shards), path.join(siteDir, "shards")):
+                    print(json.dumps(record))
+            server.shutdown()
+    elif args.stage == "throttle":
+        with tempfile.TemporaryDirectory() as siteDir:
+            server = serveSite(siteDir, ThrottlingHandler)
+            baseUrl = "http://127.0.0.1:" + str(server.server_address[1]) + "/"
+            makeSite(siteDir, baseUrl, int(args.fan_out), int(args.depth), 2000)
+            for record in benchThrottle(server, baseUrl, int(args.depth) + 2, int(args.workers), int(args.max_in_flight)):
+                print(json.dumps(record))
+            server.shutdown()
+    elif args.stage == "layout":
+        for size in args.sizes:
+            for layout in args.layouts:
+                print(json.dumps(benchLayout(int(size), layout)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import ast
+import hashlib
+import json
+import threading
+import time
+import graphstore
+from os import path, replace
+
+# version of the cache format, increased when records change
+cacheVersion = 1
+# buffered records are written to the disk at least every flushDelay seconds
+flushDelay = 1
+
+
+class CacheWriter:
+    """Class that appends the changes of a graph to a cache file, one JSON record per line"""
+
+    ### methods
+
+    ## constructor
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        # a new cache replaces the previous one
+        self._file = open(filename, "w")
+        self._file.write(json.dumps({"format": "sidemap", "version": cacheVersion}) + "\n")
+        self._lastFlush = time.monotonic()
+
+    ## writing
+
+    # record: ["node", page, nodeSize], ["size", page, increase], ["link", page, targetPage, params, method, edgeSize],
+    # ["out", page, outOfScopePage], ["outs", page, [outOfScopePage1, ...]] or ["internal", page, key, value]
+    def write(self, record: []) -> None:
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        if time.monotonic() - self._lastFlush > flushDelay:
+            self.flush()
+
+    def flush(self) -> None:
+        self._file.flush()
+        self._lastFlush = time.monotonic()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class PageValidators:
+    """Class that keeps the validators (ETag, Last-Modified, content hash) and the requests found on the visited pages,
+    to revalidate them and reuse their requests on the next crawl"""
+
+    ### methods
+
+    ## constructor
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        # {url: {"etag": , "lastModified": , "hash": , "reqs": }} of the previous crawl
+        self._previous = {}
+        if path.isfile(filename):
+            for record in iterRecords(filename):
+                self._previous[record["url"]] = record
+        # {url: {"etag": , "lastModified": , "hash": , "unchanged": }} of this crawl
+        self._current = {}
+        self._lock = threading.Lock()
+        self.revalidated = 0
+        self.unchanged = 0
+        self.refetched = 0
+        # the previous validators stay until this crawl ends
+        self._file = open(filename + ".tmp", "w")
+        self._file.write(json.dumps({"format": "sidemap", "version": cacheVersion}) + "\n")
+
+    ## fetching
+
+    # headers making the request conditional if the page was visited by the previous crawl
+    def conditionalHeaders(self, url: str) -> {}:
+        previous = self._previous.get(url)
+        headers = {}
+        if previous != None:
+            if previous["etag"] != None: headers["If-None-Match"] = previous["etag"]
+            if previous["lastModified"] != None: headers["If-Modified-Since"] = previous["lastModified"]
+        return headers
+
+    # records the response to the request of the page
+    def update(self, url: str, status: int, headers: object, body: bytes) -> None:
+        previous = self._previous.get(url)
+        with self._lock:
+            if status == 304 and previous != None:
+                self._current[url] = {"etag": previous["etag"], "lastModified": previous["lastModified"], "hash": previous["hash"], "unchanged": True}
+                self.revalidated += 1
+                return
+            contentHash = hashlib.sha256(body).hexdigest()
+            unchanged = previous != None and previous["hash"] == contentHash
+            self._current[url] = {"etag": headers.get("ETag"), "lastModified": headers.get("Last-Modified"), "hash": contentHash, "unchanged": unchanged}
+            if unchanged:
+                self.unchanged += 1
+            else:
+                self.refetched += 1
+
+    ## requests of the pages
+
+    # True if the page did not change since the previous crawl, its requests can be reused
+    def isUnchanged(self, url: str) -> bool:
+        return url in self._current and self._current[url]["unchanged"]
+
+    # [(url1, link1), (url2, link2), ...] found on the page by the previous crawl
+    def getReqs(self, url: str) -> []:
+        return [(href, link) for href, link in self._previous[url]["reqs"]]
+
+    # writes the validators and requests found on the page
+    def save(self, url: str, reqs: []) -> None:
+        current = self._current[url]
+        self._file.write(json.dumps({"url": url, "etag": current["etag"], "lastModified": current["lastModified"], "hash": current["hash"], "reqs": reqs}, separators=(",", ":")) + "\n")
+
+    def close(self) -> None:
+        self._file.close()
+        replace(self.filename + ".tmp", self.filename)
+
+    def summary(self) -> str:
+        return str(self.revalidated) + " pages revalidated, " + str(self.unchanged) + " unchanged and " + str(self.refetched) + " refetched"
+
+
+## reading
+
+# yields the records of the cache file one by one, a record cut by an interrupted crawl ends the file
+def iterRecords(filename: str):
+    with open(filename, "r") as cf:
+        header = json.loads(cf.readline())
+        if header.get("format") != "sidemap" or header.get("version") != cacheVersion:
+            raise ValueError("Unsupported cache file " + filename)
+        for line in cf:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                return
+
+# applies the records to the store (a new one by default)
+def replay(records, store: graphstore.GraphStore = None) -> graphstore.GraphStore:
+    store = graphstore.GraphStore() if store == None else store
+    for record in records:
+        if record[0] == "node":
+            store.addNode(record[1], record[2])
+        elif record[0] == "size":
+            store.increaseNodeSize(record[1], record[2])
+        elif record[0] == "link":
+            store.addLink(record[1], {"page": record[2], "params": record[3], "method": record[4], "edgeSize": record[5]})
+        elif record[0] == "out":
+            store.addOutOfScopeURL(record[1], record[2])
+        elif record[0] == "outs":
+            store.setOutOfScopeURLs(record[1], record[2])
+        elif record[0] == "internal":
+            store.setInternal(record[1], record[2], record[3])
+    return store
+
+# writes the whole graph in a new cache file
+def save(graph: {}, filename: str) -> None:
+    journal = CacheWriter(filename)
+    graphstore.GraphStore.fromDict(graph, journal)
+    journal.close()
+
+# loads the graph of the cache file name (without extension) from the cache directory,
+# cache files of former versions (python literal of the graph in name.cache) are still loaded
+def load(cacheDir: str, name: str) -> {}:
+    if path.isfile(path.join(cacheDir, name + ".jsonl")):
+        return replay(iterRecords(path.join(cacheDir, name + ".jsonl"))).toDict()
+    with open(path.join(cacheDir, name + ".cache"), "r") as cf:
+        return ast.literal_eval(cf.read())
@@ -0,0 +1,539 @@
+import asyncio
+import base64
+import frontier
+import graphstore
+import http.client
+import metrics
+import queue
+import ratecontrol
+import threading
+import time
+import url as urlmod
+import utils
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.error import HTTPError
+from urllib.parse import unquote, urlsplit, urljoin
+from urllib.request import getproxies, proxy_bypass
+
+# status codes followed as redirections, like urlopen does
+redirectCodes = (301, 302, 303, 307, 308)
+# maximum number of redirections followed for one page (same limit as urllib)
+maxRedirects = 10
+# pages being fetched or waiting for the merge in the concurrent engine, per worker
+fetchedPagesPerWorker = 4
+# fetched pages waiting for a parser, per parser, before the fetchers wait
+fetchedPagesPerParser = 4
+# pages submitted at once to the parsers, per parser
+parsingPagesPerParser = 2
+
+
+class ConnectionPool:
+    """Class that keeps keep-alive connections opened per host, one set of connections per thread,
+    through the proxies of the environment (http_proxy, https_proxy, no_proxy) like urlopen"""
+
+    ### methods
+
+    ## constructor
+    def __init__(self) -> None:
+        # each thread owns its connections, http.client ones are not thread safe
+        self._local = threading.local()
+        # every connection opened, to close them all at the end
+        self._connections = []
+        self._lock = threading.Lock()
+        # {scheme: proxy URL} of the environment, and {(scheme, netloc): proxy or None} of the hosts already requested
+        self._proxies = getproxies()
+        self._routes = {}
+
+    ## connections
+
+    # (netloc of the proxy, Proxy-Authorization header or None) of the host, None if it is requested directly
+    def _proxy(self, scheme: str, netloc: str) -> (str, str):
+        if not((scheme, netloc) in self._routes):
+            proxy = self._proxies.get(scheme)
+            if proxy == None or proxy_bypass(netloc):
+                self._routes[(scheme, netloc)] = None
+            else:
+                parts = urlsplit(proxy if "://" in proxy else "http://" + proxy)
+                authorization = None
+                if parts.username != None:
+                    authorization = "Basic " + base64.b64encode((unquote(parts.username) + ":" + unquote(parts.password or "")).encode("utf-8")).decode("ascii")
+                self._routes[(scheme, netloc)] = (parts.netloc.rpartition("@")[2], authorization)
+        return self._routes[(scheme, netloc)]
+
+    def _getConnection(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        connections = self._local.__dict__.setdefault("connections", {})
+        if not((scheme, netloc) in connections):
+            proxy = self._proxy(scheme, netloc)
+            connectionClass = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            if proxy == None:
+                connections[(scheme, netloc)] = connectionClass(netloc, timeout=ratecontrol.controller.timeout)
+            else:
+                connections[(scheme, netloc)] = connectionClass(proxy[0], timeout=ratecontrol.controller.timeout)
+                # https requests go through a CONNECT tunnel, http ones are sent to the proxy with their absolute URL
+                if scheme == "https":
+                    connections[(scheme, netloc)].set_tunnel(netloc, headers={} if proxy[1] == None else {"Proxy-Authorization": proxy[1]})
+            with self._lock:
+                self._connections.append(connections[(scheme, netloc)])
+        return connections[(scheme, netloc)]
+
+    def _dropConnection(self, scheme: str, netloc: str) -> None:
+        connection = self._local.__dict__.get("connections", {}).pop((scheme, netloc), None)
+        if connection != None:
+            connection.close()
+
+    # to call once no request is running anymore
+    def close(self) -> None:
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+    ## requests
+
+    # reader: reads the body of the response, eg. utils.readPage, all of it by default
+    def _send(self, method: str, scheme: str, netloc: str, path: str, headers: {}, reader = None) -> (int, http.client.HTTPMessage, bytes):
+        proxy = self._proxy(scheme, netloc)
+        if proxy != None and scheme != "https":
+            path = scheme + "://" + netloc + path
+            if proxy[1] != None:
+                headers = dict(headers, **{"Proxy-Authorization": proxy[1]})
+        # a kept-alive connection may have been closed by the server meanwhile, so retry once on a fresh one
+        for attempt in range(2):
+            connection = self._getConnection(scheme, netloc)
+            try:
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+                body = response.read() if reader == None else reader(response)
+            except (ConnectionError, http.client.HTTPException):
+                self._dropConnection(scheme, netloc)
+                if attempt == 1:
+                    raise
+                continue
+            except:
+                self._dropConnection(scheme, netloc)
+                raise
+            # the body must be fully read before the connection can be reused
+            if response.will_close or not(response.isclosed()):
+                self._dropConnection(scheme, netloc)
+            return (response.status, response.headers, body)
+
+    def request(self, url: str, method: str = "GET", headers: {} = {}, followRedirects: bool = True, reader = None) -> (int, http.client.HTTPMessage, bytes):
+        for redirect in range(maxRedirects + 1):
+            parts = urlsplit(url)
+            path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+            # each hop is scheduled, and retried if throttled or failed, by the rate controller of its host
+            status, responseHeaders, body = ratecontrol.controller.call(parts.netloc, lambda: self._send(method, parts.scheme, parts.netloc, path, headers, reader))
+            if followRedirects and status in redirectCodes and responseHeaders.get("Location") != None:
+                url = urljoin(url, responseHeaders.get("Location"))
+                continue
+            return (status, responseHeaders, body)
+        raise HTTPError(url, status, "Too many redirections", responseHeaders, None)
+
+    def get(self, url: str, headers: {} = {}, reader = None) -> (int, http.client.HTTPMessage, bytes):
+        # follows redirections and raises HTTPError on error codes, like urlopen
+        status, responseHeaders, body = self.request(url, "GET", headers, reader=reader)
+        if status >= 400:
+            raise HTTPError(url, status, http.client.responses.get(status, ""), responseHeaders, None)
+        return (status, responseHeaders, body)
+
+    # same as utils.doRequest
+    def doRequest(self, url: str, cookies: [] = [], validators = None) -> str:
+        headers = {"User-Agent": utils.userAgent, "Cookie": "; ".join(cookies), "Accept-Encoding": "gzip, deflate"}
+        if validators != None:
+            headers.update(validators.conditionalHeaders(url))
+        start = time.perf_counter()
+        try:
+            status, responseHeaders, body = self.get(url, headers, utils.readPage)
+            pageCode = "" if status == 304 or body == None else utils.decodePage(body, responseHeaders)
+        except HTTPError as e:
+            metrics.registry.observe("sidemap_fetch_seconds", time.perf_counter() - start)
+            metrics.registry.count("sidemap_responses_total", status=e.code)
+            raise
+        except:
+            metrics.registry.observe("sidemap_fetch_seconds", time.perf_counter() - start)
+            metrics.registry.count("sidemap_fetch_errors_total")
+            raise
+        metrics.registry.observe("sidemap_fetch_seconds", time.perf_counter() - start)
+        metrics.registry.count("sidemap_responses_total", status=status)
+        if body == None and status != 304:
+            raise utils.SkippedPage(url + " is not a page (" + str(responseHeaders.get("Content-Type")) + ")")
+        metrics.registry.observe("sidemap_response_bytes", len(body or b""))
+        if validators != None:
+            validators.update(url, status, responseHeaders, body or b"")
+        return pageCode
+
+
+class Pipeline:
+    """Class that fetches pages with threads and extracts their requests with processes, ahead of the merge of the pages"""
+
+    ### methods
+
+    ## constructor
+    def __init__(self, cookies: [] = [], workers: int = 8, parsers: int = 4, validators = None) -> None:
+        self._cookies = cookies
+        self._validators = validators
+        self._connections = ConnectionPool()
+        # the processes are started before the threads of the pipeline
+        self._parsers = ProcessPoolExecutor(max_workers=parsers)
+        self._parsers.submit(int).result()
+        self._parsingSlots = threading.Semaphore(parsingPagesPerParser * parsers)
+        self._fetchers = ThreadPoolExecutor(max_workers=workers)
+        # (url, page code) fetched and waiting for a parser, the fetchers wait when it is full
+        self._fetched = queue.Queue(maxsize=fetchedPagesPerParser * parsers)
+        # {url: future of its requests} of the submitted URLs not merged yet
+        self._results = {}
+        self._lock = threading.Lock()
+        # error which stopped the pipeline (eg. BrokenProcessPool if a parser process died), raised by result
+        self._error = None
+        self._fetching = 0
+        self._parsing = 0
+        self._parsed = 0
+        # largest queue depths seen by queueDepths
+        self.maxQueueDepths = {"fetching": 0, "fetched": 0, "parsing": 0, "parsed": 0}
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    ## stages
+
+    # fetcher thread: fetches the page and queues it for a parser, None if it cannot be fetched
+    def _fetch(self, url: urlmod.URL) -> None:
+        try:
+            pageCode = self._connections.doRequest(url.url, cookies=self._cookies, validators=self._validators)
+        except:
+            pageCode = None
+        self._fetched.put((url, pageCode))
+        with self._lock:
+            self._fetching -= 1
+
+    # dispatcher thread: hands the fetched pages to the parsers, and keeps emptying the fetched queue once the pipeline failed
+    def _dispatch(self) -> None:
+        while True:
+            fetched = self._fetched.get()
+            if fetched == None:
+                return
+            url, pageCode = fetched
+            with self._lock:
+                result = self._results.get(url)
+                error = self._error
+            # the URL was given up after an error
+            if result == None:
+                continue
+            if error != None:
+                self._setException(result, error)
+            elif pageCode == None:
+                self._setResult(result, None)
+            # the requests of an unchanged page are reused from the previous crawl
+            elif self._validators != None and self._validators.isUnchanged(url.url):
+                metrics.registry.count("sidemap_reused_pages_total")
+                self._setResult(result, self._validators.getReqs(url.url))
+            else:
+                self._parsingSlots.acquire()
+                with self._lock:
+                    self._parsing += 1
+                try:
+                    # the size limit of this process, parser processes may be started without its settings
+                    parsing = self._parsers.submit(findReqsTimed, pageCode, url, utils.maxPageSize)
+                except Exception as e:
+                    # eg. BrokenProcessPool, a parser process died
+                    with self._lock:
+                        self._parsing -= 1
+                    self._parsingSlots.release()
+                    self._fail(e)
+                    continue
+                parsing.add_done_callback(lambda parsing, result=result: self._endParsing(parsing, result))
+
+    def _endParsing(self, parsing: Future, result: Future) -> None:
+        with self._lock:
+            self._parsing -= 1
+        self._parsingSlots.release()
+        # cancelled by close, nobody waits for its requests
+        if parsing.cancelled():
+            return
+        if isinstance(parsing.exception(), BrokenProcessPool):
+            self._fail(parsing.exception())
+        elif parsing.exception() != None:
+            self._setException(result, parsing.exception())
+        else:
+            urlsAndReqs, elapsed = parsing.result()
+            metrics.registry.observe("sidemap_parse_seconds", elapsed)
+            self._setResult(result, urlsAndReqs)
+
+    def _setResult(self, result: Future, urlsAndReqs: []) -> None:
+        with self._lock:
+            if not(result.done()):
+                self._parsed += 1
+                result.set_result(urlsAndReqs)
+
+    def _setException(self, result: Future, error: Exception) -> None:
+        with self._lock:
+            if not(result.done()):
+                self._parsed += 1
+                result.set_exception(error)
+
+    # every URL waiting for its requests, and the next ones, get the error
+    def _fail(self, error: Exception) -> None:
+        with self._lock:
+            self._error = error
+            for result in self._results.values():
+                if not(result.done()):
+                    self._parsed += 1
+                    result.set_exception(error)
+
+    ## merge
+
+    # starts fetching the URL
+    def submit(self, url: urlmod.URL) -> None:
+        with self._lock:
+            self._results[url] = Future()
+            self._fetching += 1
+        self._fetchers.submit(self._fetch, url)
+
+    # waits for the requests found on the submitted URL, None if it cannot be fetched
+    def result(self, url: urlmod.URL) -> []:
+        with self._lock:
+            result = self._results[url]
+        try:
+            return result.result()
+        finally:
+            with self._lock:
+                del self._results[url]
+                self._parsed -= 1
+
+    # URLs being fetched (or waiting for the fetched queue), fetched and waiting for a parser, being parsed and parsed waiting for the merge
+    def queueDepths(self) -> {}:
+        with self._lock:
+            depths = {"fetching": self._fetching, "fetched": self._fetched.qsize(), "parsing": self._parsing, "parsed": self._parsed}
+        for stage, depth in depths.items():
+            self.maxQueueDepths[stage] = max(self.maxQueueDepths[stage], depth)
+        return depths
+
+    # to call once every submitted URL is merged, the remaining fetches and parsings are cancelled otherwise (eg. after an error)
+    def close(self) -> None:
+        with self._lock:
+            cancel = self._error != None or len(self._results) > 0
+        self._fetchers.shutdown(cancel_futures=cancel)
+        self._fetched.put(None)
+        self._dispatcher.join()
+        self._parsers.shutdown(cancel_futures=cancel)
+        self._connections.close()
+
+
+## graph
+
+# adds to the graph the links found on the visited page url and returns the in-scope URLs, in order of discovery
+def addPageLinks(graph: graphstore.GraphStore, url: urlmod.URL, urlsAndReqs: [], banExts: [], verbosity: bool = False) -> []:
+    foundUrls = []
+    for urlAndReq in urlsAndReqs:
+        foundUrl = urlmod.URL(urlAndReq[0], refUrl=url)
+        foundReq = urlAndReq[1]
+
+        if foundUrl.isUrl():
+            # foundUrl is from a website to map
+            if isPageToMap(url, foundUrl, banExts):
+                utils.printVerb(verbosity, 'G', "[+] Found a new page to map " + foundUrl.url)
+                graph.addLink(url.page, foundReq)
+                # increase degree of the target node
+                graph.increaseNodeDegree(foundUrl.page, foundReq["edgeSize"])
+                foundUrls.append(foundUrl)
+
+            else:
+                # foundUrl is not from a website to map or is a file that cannot be read (eg. picture)
+                # add foundURL to url's props
+                utils.printVerb(verbosity, 'G', "[+] Found property page " + foundUrl.url)
+                graph.addOutOfScopeURL(url.page, foundUrl.page)
+
+    graph.increaseNodeSize(url.page, graph.getLinkCount(url.page))
+    return foundUrls
+
+# whether the URL found on the visited page url is a page to map (in scope and not a banned file), or only one of its properties
+def isPageToMap(url: urlmod.URL, foundUrl: urlmod.URL, banExts: []) -> bool:
+    return bool(utils.isInScope(url.domain, foundUrl.domain)) and not(foundUrl.getExtension() in banExts)
+
+# requests of the visited page, reused from the previous crawl if the page did not change
+def findPageReqs(url: urlmod.URL, pageCode: str, validators = None) -> []:
+    if validators != None and validators.isUnchanged(url.url):
+        urlsAndReqs = validators.getReqs(url.url)
+        metrics.registry.count("sidemap_reused_pages_total")
+    else:
+        urlsAndReqs, elapsed = findReqsTimed(pageCode, url)
+        metrics.registry.observe("sidemap_parse_seconds", elapsed)
+    if validators != None:
+        validators.save(url.url, urlsAndReqs)
+    return urlsAndReqs
+
+# returns the requests of the page and the time taken to find them, eg. in a parser process
+def findReqsTimed(pageCode: str, url: urlmod.URL, maxSize: int = None) -> ([], float):
+    start = time.perf_counter()
+    urlsAndReqs = urlmod.findReqs(pageCode, url, maxSize)
+    return (urlsAndReqs, time.perf_counter() - start)
+
+def _recordFrontierSizes(toVisitUrls: frontier.Frontier) -> None:
+    for depth, size in enumerate(toVisitUrls.sizes):
+        metrics.registry.gauge("sidemap_frontier_urls", size, depth=depth)
+
+def _printQueueDepths(verbosity: bool, message: str, depths: {}) -> None:
+    utils.printVerb(verbosity, 'G', "[+] " + message + ": " + ", ".join(str(depth) + " " + stage for stage, depth in depths.items()))
+
+def _printRate(verbosity: bool, visitedPages: int, start: float) -> None:
+    elapsed = time.perf_counter() - start
+    rate = visitedPages / elapsed if elapsed > 0 else 0
+    utils.printVerb(verbosity, 'G', "[+] Crawled " + str(visitedPages) + " pages in " + "{:.2f}".format(elapsed) + "s (" + "{:.2f}".format(rate) + " pages/s)")
+
+
+## crawl engines
+
+# frontier of the root, with the seeds (eg. from sitemap.addSitemaps) queued at their depth
+def seededFrontier(rootUrl: urlmod.URL, seeds: []) -> frontier.Frontier:
+    toVisitUrls = frontier.Frontier(rootUrl)
+    for url, depth in seeds:
+        toVisitUrls.add(url, depth)
+    return toVisitUrls
+
+# serial engine: fetches one page at a time
+def crawl(graph: graphstore.GraphStore, rootUrl: urlmod.URL, maxDepth: int, banExts: [], cookies: [] = [], verbosity: bool = False, validators = None, seeds: [] = []) -> graphstore.GraphStore:
+    toVisitUrls = seededFrontier(rootUrl, seeds)
+    visitedPages = 0
+    start = time.perf_counter()
+    depth = 0
+
+    for url in toVisitUrls:
+        if toVisitUrls.depth != depth:
+            _recordFrontierSizes(toVisitUrls)
+            depth = toVisitUrls.depth
+        graph.addOutOfScopeURL("recap", url.page)
+
+        if(toVisitUrls.depth < maxDepth and url.isUrl()):
+            graph.addNode(url.page)
+            utils.printVerb(verbosity, 'W', "On page " + url.url)
+            # get page code
+            try:
+                pageCode = utils.doRequest(url.url, cookies=cookies, validators=validators)
+            except:
+                utils.printVerb(verbosity, 'R', "[-] URL " + url.url + " is not recognized")
+                continue
+            visitedPages += 1
+
+            # find urls and add the new ones to the next level of URL to visit
+            for foundUrl in addPageLinks(graph, url, findPageReqs(url, pageCode, validators), banExts, verbosity):
+                toVisitUrls.add(foundUrl)
+
+    _recordFrontierSizes(toVisitUrls)
+    _printRate(verbosity, visitedPages, start)
+    return graph
+
+# concurrent engine: fetches the pages of a depth level through a bounded pool of workers reusing connections per host,
+# and merges them in the serial order as they arrive so the graph is the same as the serial one
+def crawlConcurrent(graph: graphstore.GraphStore, rootUrl: urlmod.URL, maxDepth: int, banExts: [], cookies: [] = [], verbosity: bool = False, workers: int = 8, validators = None, seeds: [] = []) -> graphstore.GraphStore:
+    return asyncio.run(_crawlConcurrent(graph, rootUrl, maxDepth, banExts, cookies, verbosity, workers, validators, seeds))
+
+async def _crawlConcurrent(graph: graphstore.GraphStore, rootUrl: urlmod.URL, maxDepth: int, banExts: [], cookies: [], verbosity: bool, workers: int, validators, seeds: []) -> graphstore.GraphStore:
+    loop = asyncio.get_running_loop()
+    pool = ConnectionPool()
+    toVisitUrls = seededFrontier(rootUrl, seeds)
+    visitedPages = 0
+    start = time.perf_counter()
+
+    # returns None if the page cannot be fetched
+    def fetch(url: urlmod.URL) -> str:
+        try:
+            return pool.doRequest(url.url, cookies=cookies, validators=validators)
+        except:
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while toVisitUrls.hasLevel():
+            _recordFrontierSizes(toVisitUrls)
+            levelUrls = toVisitUrls.takeLevel()
+            if toVisitUrls.depth >= maxDepth:
+                for url in levelUrls:
+                    graph.addOutOfScopeURL("recap", url.page)
+                toVisitUrls.nextLevel()
+                continue
+
+            # the pages of the level are fetched ahead of the merge, but at most fetchedPagesPerWorker per worker are kept at once
+            fetchableUrls = iter([url for url in levelUrls if url.isUrl()])
+            fetching = deque()
+
+            def fetchAhead() -> None:
+                while len(fetching) < fetchedPagesPerWorker * workers:
+                    url = next(fetchableUrls, None)
+                    if url == None:
+                        return
+                    fetching.append(loop.run_in_executor(executor, fetch, url))
+
+            fetchAhead()
+            for url in levelUrls:
+                graph.addOutOfScopeURL("recap", url.page)
+                if not(url.isUrl()):
+                    continue
+
+                graph.addNode(url.page)
+                utils.printVerb(verbosity, 'W', "On page " + url.url)
+                pageCode = await fetching.popleft()
+                fetchAhead()
+                if pageCode == None:
+                    utils.printVerb(verbosity, 'R', "[-] URL " + url.url + " is not recognized")
+                    continue
+                visitedPages += 1
+
+                # find urls and add the new ones to the next level
+                for foundUrl in addPageLinks(graph, url, findPageReqs(url, pageCode, validators), banExts, verbosity):
+                    toVisitUrls.add(foundUrl)
+
+            toVisitUrls.nextLevel()
+
+    pool.close()
+    _recordFrontierSizes(toVisitUrls)
+    _printRate(verbosity, visitedPages, start)
+    return graph
+
+# pipelined engine: fetcher threads and parser processes work ahead on the URLs of the frontier,
+# while the pages are merged one after the other in the serial order so the graph is the same as the serial one
+def crawlPipelined(graph: graphstore.GraphStore, rootUrl: urlmod.URL, maxDepth: int, banExts: [], cookies: [] = [], verbosity: bool = False, workers: int = 8, parsers: int = 4, validators = None, seeds: [] = []) -> graphstore.GraphStore:
+    toVisitUrls = seededFrontier(rootUrl, seeds)
+    pipeline = Pipeline(cookies, workers, parsers, validators)
+    visitedPages = 0
+    start = time.perf_counter()
+    depth = 0
+
+    try:
+        # the root and the seeds are fetched first
+        for levelDepth, level in enumerate(toVisitUrls.levels):
+            for url in level:
+                if levelDepth < maxDepth and url.isUrl():
+                    pipeline.submit(url)
+
+        for url in toVisitUrls:
+            if toVisitUrls.depth != depth:
+                _recordFrontierSizes(toVisitUrls)
+                _printQueueDepths(verbosity, "Queues at depth " + str(toVisitUrls.depth), pipeline.queueDepths())
+                depth = toVisitUrls.depth
+            graph.addOutOfScopeURL("recap", url.page)
+
+            if(toVisitUrls.depth < maxDepth and url.isUrl()):
+                graph.addNode(url.page)
+                utils.printVerb(verbosity, 'W', "On page " + url.url)
+                urlsAndReqs = pipeline.result(url)
+                pipeline.queueDepths()
+                if urlsAndReqs == None:
+                    utils.printVerb(verbosity, 'R', "[-] URL " + url.url + " is not recognized")
+                    continue
+                visitedPages += 1
+                if validators != None:
+                    validators.save(url.url, urlsAndReqs)
+
+                # find urls, add the new ones to the next level and start fetching them
+                for foundUrl in addPageLinks(graph, url, urlsAndReqs, banExts, verbosity):
+                    if toVisitUrls.add(foundUrl) and toVisitUrls.depth + 1 < maxDepth and foundUrl.isUrl():
+                        pipeline.submit(foundUrl)
+    finally:
+        pipeline.close()
+
+    _recordFrontierSizes(toVisitUrls)
+    for stage, depth in pipeline.maxQueueDepths.items():
+        metrics.registry.gauge("sidemap_pipeline_max_queue_depth", depth, queue=stage)
+    _printQueueDepths(verbosity, "Largest queues", pipeline.maxQueueDepths)
+    _printRate(verbosity, visitedPages, start)
+    return graph
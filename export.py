@@ -0,0 +1,94 @@
+import graphstore
+import gzip
+import json
+import re
+import sys
+import utils
+from xml.sax.saxutils import escape, quoteattr
+
+# version of the JSON lines format, increased when records change
+exportVersion = 1
+# output format of each file extension
+formatExtensions = {".graphml": "graphml", ".jsonl": "jsonl", ".dot": "dot", ".gv": "dot"}
+# characters XML 1.0 does not allow, eg. a control character decoded from a %01 of a sitemap
+invalidXmlRegex = re.compile('[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]')
+
+
+## nodes
+
+# yields (page, attributes) of each node: a GraphStore is read one node at a time, the links of each node being aggregated
+# as by utils.computeGlobalLinkSize, a graph of dicts is read as is (after utils.computeGlobalLinkSize)
+def iterNodes(graph: {}):
+    if isinstance(graph, graphstore.GraphStore):
+        for page, attributes in graph.iterNodes():
+            attributes["links"] = utils.globalLinks(attributes["links"])
+            yield (page, attributes)
+    else:
+        yield from graph.items()
+
+
+## writers
+# nodes and edges are written one by one, without building the graph of dicts from a GraphStore nor a networkx graph
+
+# header {"format": "sidemap-graph", "version": 1}, then {"type": "node", "id": page, "size": nodeSize, "outOfScopeURLs": []}
+# followed by the {"type": "edge", "source": page, "target": linked page, "method": , "params": [], "edgeSize": } of the node
+def writeJsonl(graph: {}, output) -> None:
+    output.write(json.dumps({"format": "sidemap-graph", "version": exportVersion}) + "\n")
+    for page, attributes in iterNodes(graph):
+        output.write(json.dumps({"type": "node", "id": page, "size": attributes["internal"]["nodeSize"], "outOfScopeURLs": attributes["outOfScopeURLs"]}, separators=(",", ":")) + "\n")
+        for link in attributes["links"]:
+            output.write(json.dumps({"type": "edge", "source": page, "target": link["page"], "method": link["method"], "params": link["params"], "edgeSize": link["edgeSize"]}, separators=(",", ":")) + "\n")
+
+def writeGraphML(graph: {}, output) -> None:
+    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    output.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+    output.write('<key id="size" for="node" attr.name="size" attr.type="long"/>\n')
+    output.write('<key id="outOfScopeURLs" for="node" attr.name="outOfScopeURLs" attr.type="string"/>\n')
+    output.write('<key id="method" for="edge" attr.name="method" attr.type="string"/>\n')
+    output.write('<key id="params" for="edge" attr.name="params" attr.type="string"/>\n')
+    output.write('<key id="edgeSize" for="edge" attr.name="edgeSize" attr.type="long"/>\n')
+    output.write('<graph id="sidemap" edgedefault="directed">\n')
+    for page, attributes in iterNodes(graph):
+        output.write('<node id=' + quoteattr(_xmlString(page)) + '><data key="size">' + str(attributes["internal"]["nodeSize"]) + '</data><data key="outOfScopeURLs">' + escape(_xmlString('\n'.join(attributes["outOfScopeURLs"]))) + '</data></node>\n')
+        for link in attributes["links"]:
+            output.write('<edge source=' + quoteattr(_xmlString(page)) + ' target=' + quoteattr(_xmlString(link["page"])) + '><data key="method">' + escape(_xmlString(link["method"])) + '</data><data key="params">' + escape(_xmlString('\n'.join(link["params"]))) + '</data><data key="edgeSize">' + str(link["edgeSize"]) + '</data></edge>\n')
+    output.write('</graph>\n</graphml>\n')
+
+# percent-encodes (as in a URL) the characters XML 1.0 does not allow
+def _xmlString(string: str) -> str:
+    return invalidXmlRegex.sub(lambda match: ''.join("%{:02X}".format(byte) for byte in match.group().encode("utf-8", "surrogatepass")), string)
+
+def writeDot(graph: {}, output) -> None:
+    output.write("digraph sidemap {\n")
+    for page, attributes in iterNodes(graph):
+        output.write("  " + _dotString(page) + " [size=" + str(attributes["internal"]["nodeSize"]) + ", tooltip=" + _dotString('\n'.join(attributes["outOfScopeURLs"])) + "];\n")
+        for link in attributes["links"]:
+            output.write("  " + _dotString(page) + " -> " + _dotString(link["page"]) + " [method=" + _dotString(link["method"]) + ", label=" + _dotString('\n'.join(link["params"])) + ", weight=" + str(link["edgeSize"]) + "];\n")
+    output.write("}\n")
+
+def _dotString(string: str) -> str:
+    return '"' + string.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+
+## files
+
+# format of the output file from its extension (a .gz extension compresses it), None if unknown
+def guessFormat(filename: str) -> str:
+    filename = filename[:-3] if filename.endswith(".gz") else filename
+    for extension, outputFormat in formatExtensions.items():
+        if filename.endswith(extension):
+            return outputFormat
+    return None
+
+# writes the graph (a GraphStore, or a graph of dicts after utils.computeGlobalLinkSize) in filename ("-" for the standard output) in the given format (guessed from the extension by default)
+def exportGraph(graph: {}, filename: str, outputFormat: str = None) -> None:
+    outputFormat = guessFormat(filename) if outputFormat == None else outputFormat
+    writers = {"graphml": writeGraphML, "jsonl": writeJsonl, "dot": writeDot}
+    if not(outputFormat in writers):
+        raise ValueError("Unknown output format for " + filename + ", use one of " + ", ".join(writers))
+    if filename == "-":
+        writers[outputFormat](graph, sys.stdout)
+        sys.stdout.flush()
+        return
+    with (gzip.open(filename, "wt", encoding="utf-8") if filename.endswith(".gz") else open(filename, "w", encoding="utf-8")) as output:
+        writers[outputFormat](graph, output)
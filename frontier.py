@@ -0,0 +1,63 @@
+from collections import deque
+import url as urlmod
+
+class Frontier:
+    """Class that defines the URLs to visit, queued by depth, and the URLs already seen"""
+
+    ### attributes
+    # depth of the level being visited
+    depth = 0
+    # [deque([url1, url2]), deque([url3]), ...], URLs to visit at each depth
+    levels = []
+    # [1, 12, 140, ...], URLs queued at each depth
+    sizes = []
+
+    ### methods
+
+    ## constructor
+    def __init__(self, rootUrl: urlmod.URL) -> None:
+        self.depth = 0
+        self.levels = [deque([rootUrl])]
+        self.sizes = [1]
+        self._seen = {rootUrl}
+
+    def __contains__(self, url: urlmod.URL) -> bool:
+        return url in self._seen
+
+    def __len__(self) -> int:
+        return sum(len(level) for level in self.levels[self.depth:])
+
+    # yields the URLs level after level, URLs added meanwhile included
+    def __iter__(self):
+        while self.hasLevel():
+            level = self.levels[self.depth]
+            while level:
+                yield level.popleft()
+            self.nextLevel()
+
+    ## queue
+
+    # queues the URL at the given depth (next level by default), returns False if it was already seen
+    def add(self, url: urlmod.URL, depth: int = None) -> bool:
+        if url in self._seen:
+            return False
+        depth = self.depth + 1 if depth == None else max(depth, self.depth)
+        while len(self.levels) <= depth:
+            self.levels.append(deque())
+            self.sizes.append(0)
+        self._seen.add(url)
+        self.levels[depth].append(url)
+        self.sizes[depth] += 1
+        return True
+
+    def hasLevel(self) -> bool:
+        return self.depth < len(self.levels)
+
+    # returns the URLs of the current level and empties it
+    def takeLevel(self) -> []:
+        level = list(self.levels[self.depth])
+        self.levels[self.depth].clear()
+        return level
+
+    def nextLevel(self) -> None:
+        self.depth += 1
@@ -0,0 +1,220 @@
+from array import array
+
+class GraphStore:
+    """Class that stores the graph compactly: pages are interned as ids and edges are kept in parallel arrays"""
+
+    __slots__ = ("_pages", "_pageIds", "_isNode", "_nodeOrder", "_nodeSizes", "_linkCounts", "_outOfScopeSources", "_outOfScopeTargets", "_outOfScopeKeys", "_outOfScopePages", "_outOfScopeIds", "_internals", "_edgeSources", "_edgeTargets", "_edgeSizes", "_edgeMethods", "_edgeParams", "_methods", "_methodIds", "_params", "_paramsIds", "_journal")
+
+    ### methods
+
+    ## constructor
+    def __init__(self, journal: object = None) -> None:
+        # page of each id, id of each page (nodes and edge targets)
+        self._pages = []
+        self._pageIds = {}
+        # 1 if the page is a node of the graph
+        self._isNode = bytearray()
+        # node ids in order of creation
+        self._nodeOrder = array('I')
+        self._nodeSizes = array('q')
+        self._linkCounts = array('I')
+        # out of scope URL i of node _outOfScopeSources[i] is _outOfScopePages[_outOfScopeTargets[i]]
+        self._outOfScopeSources = array('I')
+        self._outOfScopeTargets = array('I')
+        # {nodeId << 32 | outOfScopeId}, to check if a node already has an out of scope URL
+        self._outOfScopeKeys = set()
+        # interned out of scope URLs, shared by all nodes
+        self._outOfScopePages = []
+        self._outOfScopeIds = {}
+        # {nodeId: {key: value}}, internal attributes other than nodeSize
+        self._internals = {}
+        # edge i goes from _edgeSources[i] to _edgeTargets[i]
+        self._edgeSources = array('I')
+        self._edgeTargets = array('I')
+        self._edgeSizes = array('q')
+        self._edgeMethods = array('H')
+        self._edgeParams = array('I')
+        # interned methods and params
+        self._methods = []
+        self._methodIds = {}
+        self._params = []
+        self._paramsIds = {}
+        # receives every change as a record, eg. a cache.CacheWriter
+        self._journal = journal
+
+    def __contains__(self, page: str) -> bool:
+        pageId = self._pageIds.get(page)
+        return pageId != None and self._isNode[pageId] == 1
+
+    def __len__(self) -> int:
+        return len(self._nodeOrder)
+
+    ## interning
+
+    def _pageId(self, page: str) -> int:
+        pageId = self._pageIds.get(page)
+        if pageId == None:
+            pageId = len(self._pages)
+            self._pages.append(page)
+            self._pageIds[page] = pageId
+            self._isNode.append(0)
+            self._nodeSizes.append(0)
+            self._linkCounts.append(0)
+        return pageId
+
+    def _methodId(self, method: str) -> int:
+        if not(method in self._methodIds):
+            self._methodIds[method] = len(self._methods)
+            self._methods.append(method)
+        return self._methodIds[method]
+
+    def _paramsId(self, params: []) -> int:
+        params = tuple(params)
+        if not(params in self._paramsIds):
+            self._paramsIds[params] = len(self._params)
+            self._params.append(params)
+        return self._paramsIds[params]
+
+    ## nodes
+
+    # creates the node if it does not exist yet
+    def addNode(self, page: str, nodeSize: int = 1) -> None:
+        pageId = self._pageId(page)
+        if self._isNode[pageId] == 0:
+            self._isNode[pageId] = 1
+            self._nodeOrder.append(pageId)
+            self._nodeSizes[pageId] = nodeSize
+            if self._journal != None: self._journal.write(["node", page, nodeSize])
+
+    def getNodeSize(self, page: str) -> int:
+        return self._nodeSizes[self._pageIds[page]]
+
+    def increaseNodeSize(self, page: str, size: int) -> None:
+        self._nodeSizes[self._pageIds[page]] += size
+        if self._journal != None: self._journal.write(["size", page, size])
+
+    # same as utils.increaseNodeDegree
+    def increaseNodeDegree(self, page: str, degree: int = 2) -> None:
+        if page in self:
+            self.increaseNodeSize(page, degree - 1)
+        else:
+            # minimal nodeSize + 1
+            self.addNode(page, 2)
+
+    def getInternal(self, page: str, key: str, default: object = None) -> object:
+        if key == "nodeSize":
+            return self.getNodeSize(page)
+        return self._internals.get(self._pageIds[page], {}).get(key, default)
+
+    def setInternal(self, page: str, key: str, value: object) -> None:
+        if key == "nodeSize":
+            self._nodeSizes[self._pageIds[page]] = value
+        else:
+            self._internals.setdefault(self._pageIds[page], {})[key] = value
+        if self._journal != None: self._journal.write(["internal", page, key, value])
+
+    ## out of scope URLs
+
+    def addOutOfScopeURL(self, page: str, outOfScopePage: str) -> None:
+        outOfScopeId = self._outOfScopeIds.get(outOfScopePage)
+        if outOfScopeId == None:
+            outOfScopeId = len(self._outOfScopePages)
+            self._outOfScopePages.append(outOfScopePage)
+            self._outOfScopeIds[outOfScopePage] = outOfScopeId
+        pageId = self._pageIds[page]
+        if not(pageId << 32 | outOfScopeId in self._outOfScopeKeys):
+            self._outOfScopeKeys.add(pageId << 32 | outOfScopeId)
+            self._outOfScopeSources.append(pageId)
+            self._outOfScopeTargets.append(outOfScopeId)
+            if self._journal != None: self._journal.write(["out", page, outOfScopePage])
+
+    def hasOutOfScopeURL(self, page: str, outOfScopePage: str) -> bool:
+        outOfScopeId = self._outOfScopeIds.get(outOfScopePage)
+        return outOfScopeId != None and (self._pageIds[page] << 32 | outOfScopeId) in self._outOfScopeKeys
+
+    def getOutOfScopeURLs(self, page: str) -> []:
+        pageId = self._pageIds[page]
+        return [self._outOfScopePages[self._outOfScopeTargets[index]] for index in range(len(self._outOfScopeSources)) if self._outOfScopeSources[index] == pageId]
+
+    # replaces the out of scope URLs of the node, eg. to sort them
+    def setOutOfScopeURLs(self, page: str, outOfScopePages: []) -> None:
+        pageId = self._pageIds[page]
+        kept = [index for index in range(len(self._outOfScopeSources)) if self._outOfScopeSources[index] != pageId]
+        self._outOfScopeSources = array('I', [self._outOfScopeSources[index] for index in kept])
+        self._outOfScopeTargets = array('I', [self._outOfScopeTargets[index] for index in kept])
+        self._outOfScopeKeys = {key for key in self._outOfScopeKeys if key >> 32 != pageId}
+        journal, self._journal = self._journal, None
+        for outOfScopePage in outOfScopePages:
+            self.addOutOfScopeURL(page, outOfScopePage)
+        self._journal = journal
+        if self._journal != None: self._journal.write(["outs", page, list(outOfScopePages)])
+
+    ## edges
+
+    # link: {"page": "example.com", "params": ["key1=value1"], "method": "GET", "edgeSize": 2}
+    def addLink(self, page: str, link: {}) -> None:
+        sourceId = self._pageIds[page]
+        self._edgeSources.append(sourceId)
+        self._edgeTargets.append(self._pageId(link["page"]))
+        self._edgeSizes.append(link["edgeSize"])
+        self._edgeMethods.append(self._methodId(link["method"]))
+        self._edgeParams.append(self._paramsId(link["params"]))
+        self._linkCounts[sourceId] += 1
+        if self._journal != None: self._journal.write(["link", page, link["page"], link["params"], link["method"], link["edgeSize"]])
+
+    def getLinkCount(self, page: str) -> int:
+        return self._linkCounts[self._pageIds[page]]
+
+    def _link(self, index: int) -> {}:
+        return {"page": self._pages[self._edgeTargets[index]], "params": list(self._params[self._edgeParams[index]]), "method": self._methods[self._edgeMethods[index]], "edgeSize": self._edgeSizes[index]}
+
+    # yields (source page, link) in order of insertion
+    def iterLinks(self):
+        for index in range(len(self._edgeSources)):
+            yield (self._pages[self._edgeSources[index]], self._link(index))
+
+    ## adapters
+
+    # indexes of sourceIds grouped by page id: those of page id i are order[starts[i]:starts[i + 1]], in order of insertion
+    def _groupBySource(self, sourceIds: array) -> (array, array):
+        starts = array('I', [0]) * (len(self._pages) + 1)
+        for sourceId in sourceIds:
+            starts[sourceId + 1] += 1
+        for pageId in range(len(self._pages)):
+            starts[pageId + 1] += starts[pageId]
+        positions = array('I', starts)
+        order = array('I', [0]) * len(sourceIds)
+        for index, sourceId in enumerate(sourceIds):
+            order[positions[sourceId]] = index
+            positions[sourceId] += 1
+        return (starts, order)
+
+    # yields (page, attributes) of each node in order of creation, the attributes of one node at a time being those of toDict
+    def iterNodes(self):
+        edgeStarts, edgeOrder = self._groupBySource(self._edgeSources)
+        outOfScopeStarts, outOfScopeOrder = self._groupBySource(self._outOfScopeSources)
+        for pageId in self._nodeOrder:
+            internal = {"nodeSize": self._nodeSizes[pageId]}
+            internal.update(self._internals.get(pageId, {}))
+            links = [self._link(edgeOrder[position]) for position in range(edgeStarts[pageId], edgeStarts[pageId + 1])]
+            outOfScopeURLs = [self._outOfScopePages[self._outOfScopeTargets[outOfScopeOrder[position]]] for position in range(outOfScopeStarts[pageId], outOfScopeStarts[pageId + 1])]
+            yield (self._pages[pageId], {"links": links, "outOfScopeURLs": outOfScopeURLs, "internal": internal})
+
+    # graph as the dict of dicts used by utils (colorNodes, colorEdges, makeNXGraph, ...)
+    def toDict(self) -> {}:
+        return dict(self.iterNodes())
+
+    @classmethod
+    def fromDict(cls, graph: {}, journal: object = None) -> "GraphStore":
+        store = cls(journal)
+        for page, attributes in graph.items():
+            store.addNode(page, attributes["internal"]["nodeSize"])
+            for key, value in attributes["internal"].items():
+                if key != "nodeSize":
+                    store.setInternal(page, key, value)
+            for outOfScopePage in attributes["outOfScopeURLs"]:
+                store.addOutOfScopeURL(page, outOfScopePage)
+        for page, attributes in graph.items():
+            for link in attributes["links"]:
+                store.addLink(page, link)
+        return store
@@ -0,0 +1,166 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from os import replace
+
+# upper bounds of the histogram buckets
+latencyBuckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+sizeBuckets = [1000, 10000, 50000, 100000, 500000, 1000000, 5000000, 10000000]
+parseBuckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1]
+
+# {name: (type, help, histogram buckets)} of the recorded metrics
+metricDefinitions = {
+    "sidemap_fetch_seconds": ("histogram", "Time to fetch a page, redirections included", latencyBuckets),
+    "sidemap_response_bytes": ("histogram", "Size of the body of the fetched pages", sizeBuckets),
+    "sidemap_responses_total": ("counter", "Responses to the page requests by status code", None),
+    "sidemap_fetch_errors_total": ("counter", "Page requests failed without a status code (eg. connection error, undecodable page)", None),
+    "sidemap_transferred_bytes_total": ("counter", "Bytes of the page responses received, before decompression", None),
+    "sidemap_skipped_pages_total": ("counter", "Responses not read as they are not pages (eg. images, archives)", None),
+    "sidemap_truncated_pages_total": ("counter", "Pages cut at the maximum page size", None),
+    "sidemap_parse_seconds": ("histogram", "Time to extract the requests of a page", parseBuckets),
+    "sidemap_reused_pages_total": ("counter", "Pages whose requests are reused from the previous crawl", None),
+    "sidemap_probes_total": ("counter", "Probed known pages by status code (none if unreachable)", None),
+    "sidemap_frontier_urls": ("gauge", "URLs queued at each depth", None),
+    "sidemap_pipeline_max_queue_depth": ("gauge", "Largest depth of each queue of the pipelined crawl", None),
+    "sidemap_stage_seconds": ("gauge", "Time spent in each stage of the run", None),
+    "sidemap_host_concurrency": ("gauge", "Requests allowed at once to each host", None),
+    "sidemap_host_requests_per_second": ("gauge", "Requests per second to each host over the last seconds", None),
+    "sidemap_throttled_total": ("counter", "Responses asking to slow down (429, 503) by host and status code", None),
+    "sidemap_request_failures_total": ("counter", "Requests failed without a response (timeout, refused or reset connection) by host", None),
+    "sidemap_retries_total": ("counter", "Retried requests by host", None),
+}
+
+
+class Metrics:
+    """Class that records the counters, gauges and histograms of a run, and exports them as JSON or in the Prometheus text format"""
+
+    ### methods
+
+    ## constructor
+    def __init__(self) -> None:
+        # {name: {labels: value}}, a histogram value is [count per bucket (+Inf last), sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+        self._exporter = None
+        self._stopExporting = threading.Event()
+
+    ## recording
+
+    # labels: label names and values, eg. status=200
+    def count(self, name: str, amount: int = 1, **labels) -> None:
+        key = _labelsKey(labels)
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+
+    def gauge(self, name: str, value: float, **labels) -> None:
+        key = _labelsKey(labels)
+        with self._lock:
+            self._values.setdefault(name, {})[key] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = _labelsKey(labels)
+        buckets = metricDefinitions[name][2]
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            if not(key in values):
+                values[key] = [[0] * (len(buckets) + 1), 0, 0]
+            histogram = values[key]
+            histogram[0][bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    # times the block in the gauge name
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.gauge(name, time.perf_counter() - start, **labels)
+
+    # sum of the counter or gauge over its labels, or sum of the observed values of the histogram
+    def total(self, name: str) -> float:
+        with self._lock:
+            values = self._values.get(name, {}).values()
+            return sum(value[1] if metricDefinitions[name][0] == "histogram" else value for value in values)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values = {}
+
+    ## export
+
+    # {name: {"type": , "help": , "values": [{"labels": {}, "value": } or {"labels": {}, "buckets": {upper bound: cumulative count}, "sum": , "count": }]}}
+    def summary(self) -> {}:
+        summary = {}
+        with self._lock:
+            for name, values in self._values.items():
+                metricType, description, buckets = metricDefinitions[name]
+                entries = []
+                for key, value in values.items():
+                    if metricType == "histogram":
+                        cumulated = 0
+                        cumulatedBuckets = {}
+                        for bound, bucketCount in zip(buckets + ["+Inf"], value[0]):
+                            cumulated += bucketCount
+                            cumulatedBuckets[str(bound)] = cumulated
+                        entries.append({"labels": dict(key), "buckets": cumulatedBuckets, "sum": value[1], "count": value[2]})
+                    else:
+                        entries.append({"labels": dict(key), "value": value})
+                summary[name] = {"type": metricType, "help": description, "values": entries}
+        return summary
+
+    def toPrometheus(self) -> str:
+        lines = []
+        for name, metric in self.summary().items():
+            lines.append("# HELP " + name + " " + metric["help"])
+            lines.append("# TYPE " + name + " " + metric["type"])
+            for entry in metric["values"]:
+                if metric["type"] == "histogram":
+                    for bound, bucketCount in entry["buckets"].items():
+                        lines.append(name + "_bucket" + _promLabels(dict(entry["labels"], le=bound)) + " " + str(bucketCount))
+                    lines.append(name + "_sum" + _promLabels(entry["labels"]) + " " + str(entry["sum"]))
+                    lines.append(name + "_count" + _promLabels(entry["labels"]) + " " + str(entry["count"]))
+                else:
+                    lines.append(name + _promLabels(entry["labels"]) + " " + str(entry["value"]))
+        return "\n".join(lines) + "\n"
+
+    # writes prefix.json and prefix.prom, replaced at once so a reader never sees a partial file
+    def export(self, prefix: str) -> None:
+        for extension, content in [(".json", json.dumps(self.summary(), indent=1)), (".prom", self.toPrometheus())]:
+            with open(prefix + extension + ".tmp", "w") as metricsFile:
+                metricsFile.write(content)
+            replace(prefix + extension + ".tmp", prefix + extension)
+
+    # exports the metrics every interval seconds until stopExporting
+    def startExporting(self, prefix: str, interval: float) -> None:
+        self._stopExporting.clear()
+
+        def exportPeriodically() -> None:
+            while not(self._stopExporting.wait(interval)):
+                self.export(prefix)
+
+        self._exporter = threading.Thread(target=exportPeriodically, daemon=True)
+        self._exporter.start()
+
+    def stopExporting(self) -> None:
+        if self._exporter != None:
+            self._stopExporting.set()
+            self._exporter.join()
+            self._exporter = None
+
+
+# hashable key of the labels, whatever their order
+def _labelsKey(labels: {}) -> ():
+    return tuple(sorted((label, str(labelValue)) for label, labelValue in labels.items()))
+
+def _promLabels(labels: {}) -> str:
+    if labels == {}:
+        return ""
+    return "{" + ",".join(label + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for label, value in labels.items()) + "}"
+
+# metrics of the running crawl, recorded by the crawler, the prober and main
+registry = Metrics()
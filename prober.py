@@ -0,0 +1,87 @@
+import crawler
+import graphstore
+import metrics
+import url as urlmod
+import utils
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+# well known pages probed when no wordlist is given
+defaultWellKnowns = ["robots.txt", "security.txt", "sitemap.xml", "xmlrpc.php", "wp-admin/login.php", "wp-admin/wp-login.php", "login.php", "wp-login.php", "admin"]
+# status codes meaning the server does not handle HEAD requests
+headRefusedCodes = (400, 403, 405, 501)
+# bytes read at most of the answer to the ranged GET, for the servers which ignore the range
+probeReadSize = 1024
+
+
+## wordlist
+
+# one path per line, empty lines and lines starting with '#' are ignored
+def readWordlist(filename: str) -> []:
+    with open(filename, "r") as wl:
+        return [line.strip() for line in wl if line.strip() != "" and not(line.strip().startswith("#"))]
+
+
+## probe
+
+# returns (status code, redirection target or None) of the URL, without downloading its content
+def probeUrl(pool: crawler.ConnectionPool, url: str, cookies: [] = []) -> (int, str):
+    headers = {"User-Agent": utils.userAgent, "Cookie": "; ".join(cookies)}
+    status, responseHeaders, body = pool.request(url, "HEAD", headers, followRedirects=False)
+    # some servers refuse HEAD requests, ask them for the first byte only
+    if status in headRefusedCodes:
+        status, responseHeaders, body = pool.request(url, "GET", dict(headers, Range="bytes=0-0"), followRedirects=False, reader=lambda response: response.read(probeReadSize))
+        # a partial content is a found page
+        if status == 206:
+            status = 200
+    location = responseHeaders.get("Location")
+    return (status, None if location == None else urljoin(url, location))
+
+# probes the URLs concurrently, returns [(url, status code or None if unreachable, redirection target or None), ...] in the given order
+def probe(urls: [], cookies: [] = [], workers: int = 16) -> []:
+    pool = crawler.ConnectionPool()
+
+    def probeOrNone(url: urlmod.URL) -> (int, str):
+        try:
+            return probeUrl(pool, url.url, cookies)
+        except:
+            return (None, None)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(probeOrNone, urls))
+    pool.close()
+    for status, location in results:
+        metrics.registry.count("sidemap_probes_total", status="none" if status == None else status)
+    return [(url, status, location) for url, (status, location) in zip(urls, results)]
+
+
+## graph
+
+# adds the found known pages to the graph and records every probe in the "known pages" node
+def addKnownPages(graph: graphstore.GraphStore, probes: [], verbosity: bool = False) -> graphstore.GraphStore:
+    knownProbes = graph.getInternal("known pages", "probes", {})
+    for wellKnown, statusCode, location in probes:
+        if statusCode == None:
+            utils.printVerb(verbosity, 'R', "[-] Error with the URL " + wellKnown.url)
+            continue
+        knownProbes[wellKnown.page] = {"status": statusCode, "location": location}
+
+        # if page exists or redirects somewhere
+        if 200 <= statusCode < 400:
+            utils.printVerb(verbosity, 'G', "[+] Found known page " + wellKnown.url + ("" if location == None else " redirecting to " + location))
+
+            # add to the recap and known pages
+            graph.addOutOfScopeURL("recap", wellKnown.page)
+            graph.addOutOfScopeURL("known pages", wellKnown.page)
+
+            # create and link a new node for the known page
+            graph.addNode(wellKnown.page, 2)
+            graph.addLink("known pages", {"page": wellKnown.page, "params": [], "method": "GET", "edgeSize": 2})
+
+            # increase known pages node degree
+            graph.increaseNodeSize("known pages", 1)
+
+        else:
+            utils.printVerb(verbosity, 'Y', "[-] Known page " + wellKnown.url + " returned " + str(statusCode))
+    graph.setInternal("known pages", "probes", knownProbes)
+    return graph
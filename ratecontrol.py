@@ -0,0 +1,252 @@
+import http.client
+import metrics
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from urllib.error import HTTPError, URLError
+
+# status codes of a server asking to slow down, the request is retried later
+throttledCodes = (429, 503)
+# retries of a throttled or failed request, seconds before giving up on a response
+defaultRetries = 3
+defaultTimeout = 30
+# first and maximum backoff before a retry, the actual one is drawn at random below (full jitter)
+backoffBase = 0.5
+backoffCap = 30
+# longest pause accepted from a Retry-After header
+maxRetryAfter = 300
+# the concurrency of a host decreases by this factor on errors, and on latencies this many times its lowest one
+decreaseFactor = 0.5
+latencyDecreaseFactor = 0.75
+latencyFactor = 3
+# latencies closer than this to the lowest one are never a slowdown (eg. jitter on a local network)
+latencyMargin = 0.05
+# weight of the last latency in the moving average
+latencyWeight = 0.2
+# seconds of requests counted in the current rate
+rateWindow = 10
+
+
+class HostState:
+    """Class that keeps the concurrency, pauses and statistics of the requests to one host"""
+
+    __slots__ = ("concurrency", "inFlight", "nextAllowed", "crawlDelay", "latency", "lowestLatency", "lastDecrease", "completions", "requests", "errors", "throttled", "retries")
+
+    ### methods
+
+    ## constructor
+    def __init__(self, concurrency: float) -> None:
+        # requests allowed at once (AIMD), and running
+        self.concurrency = concurrency
+        self.inFlight = 0
+        # no request starts before this time (crawl delay, Retry-After)
+        self.nextAllowed = 0
+        self.crawlDelay = 0
+        # moving average and lowest moving average of the latency
+        self.latency = None
+        self.lowestLatency = None
+        self.lastDecrease = 0
+        # end times of the last requests, for the current rate
+        self.completions = deque()
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.retries = 0
+
+
+class RateController:
+    """Class that schedules the requests of each host: concurrency increased while the host answers well and decreased on errors,
+    throttling or slowdowns (AIMD), crawl delays and Retry-After pauses, and retries of transient failures with a jittered backoff"""
+
+    ### methods
+
+    ## constructor
+    def __init__(self, maxConcurrency: int = 16, retries: int = defaultRetries, timeout: float = defaultTimeout) -> None:
+        self.maxConcurrency = maxConcurrency
+        self.retries = retries
+        self.timeout = timeout
+        self._hosts = {}
+        self._condition = threading.Condition()
+
+    def configure(self, maxConcurrency: int = None, retries: int = None, timeout: float = None) -> None:
+        with self._condition:
+            if maxConcurrency != None: self.maxConcurrency = maxConcurrency
+            if retries != None: self.retries = retries
+            if timeout != None: self.timeout = timeout
+            for state in self._hosts.values():
+                state.concurrency = min(state.concurrency, self.maxConcurrency)
+
+    def setCrawlDelay(self, host: str, seconds: float) -> None:
+        with self._condition:
+            self._host(host).crawlDelay = seconds
+
+    def _host(self, host: str) -> HostState:
+        if not(host in self._hosts):
+            # hosts start at full concurrency, and slow down when they show it
+            self._hosts[host] = HostState(self.maxConcurrency)
+        return self._hosts[host]
+
+    ## scheduling
+
+    # waits until a request to the host may start
+    def acquire(self, host: str) -> None:
+        with self._condition:
+            state = self._host(host)
+            while True:
+                wait = state.nextAllowed - time.monotonic()
+                if state.inFlight < max(int(state.concurrency), 1) and wait <= 0:
+                    break
+                self._condition.wait(wait if wait > 0 else None)
+            state.inFlight += 1
+            if state.crawlDelay > 0:
+                state.nextAllowed = time.monotonic() + state.crawlDelay
+
+    # outcome: "ok", "throttled", "error" (transient) or "failed", pause: seconds without request to the host (eg. Retry-After)
+    def release(self, host: str, latency: float, outcome: str, pause: float = 0) -> None:
+        with self._condition:
+            state = self._host(host)
+            now = time.monotonic()
+            state.inFlight -= 1
+            state.requests += 1
+            state.completions.append(now)
+            while state.completions[0] < now - rateWindow:
+                state.completions.popleft()
+
+            if outcome == "ok":
+                state.latency = latency if state.latency == None else (1 - latencyWeight) * state.latency + latencyWeight * latency
+                state.lowestLatency = state.latency if state.lowestLatency == None else min(state.lowestLatency, state.latency)
+                # slowing down host, at most one decrease per latency
+                if state.latency > latencyFactor * state.lowestLatency and state.latency - state.lowestLatency > latencyMargin:
+                    if now - state.lastDecrease > state.latency:
+                        state.concurrency = max(state.concurrency * latencyDecreaseFactor, 1)
+                        state.lastDecrease = now
+                else:
+                    # about one more request at once per round of requests
+                    state.concurrency = min(state.concurrency + 1 / state.concurrency, self.maxConcurrency)
+            elif outcome == "failed":
+                state.errors += 1
+            else:
+                if outcome == "throttled":
+                    state.throttled += 1
+                else:
+                    state.errors += 1
+                if now - state.lastDecrease > (state.latency or 0):
+                    state.concurrency = max(state.concurrency * decreaseFactor, 1)
+                    state.lastDecrease = now
+            if pause > 0:
+                state.nextAllowed = max(state.nextAllowed, now + pause)
+
+            metrics.registry.gauge("sidemap_host_concurrency", state.concurrency, host=host)
+            metrics.registry.gauge("sidemap_host_requests_per_second", len(state.completions) / rateWindow, host=host)
+            self._condition.notify_all()
+
+    # sends the request to the host with send() -> (status, headers, payload), which may raise HTTPError like urlopen,
+    # retries throttled and failed requests, and returns the last response or raises the last error
+    def call(self, host: str, send) -> (int, object, object):
+        for attempt in range(self.retries + 1):
+            self.acquire(host)
+            start = time.monotonic()
+            error = None
+            try:
+                status, headers, payload = send()
+            except HTTPError as e:
+                status, headers, error = e.code, e.headers, e
+            except (OSError, http.client.HTTPException) as e:
+                metrics.registry.count("sidemap_request_failures_total", host=host)
+                # an invalid URL, unknown host or TLS error fails again, without slowing down the host
+                if not(isTransient(e)):
+                    self.release(host, time.monotonic() - start, "failed")
+                    raise
+                # timeout, refused or reset connection, only this request waits before its retry
+                self.release(host, time.monotonic() - start, "error")
+                if attempt == self.retries:
+                    raise
+                self._retried(host)
+                time.sleep(backoff(attempt))
+                continue
+            except:
+                self.release(host, time.monotonic() - start, "failed")
+                raise
+
+            if status in throttledCodes:
+                pause = retryAfter(headers)
+                self.release(host, time.monotonic() - start, "throttled", backoff(attempt) if pause == None else pause)
+                metrics.registry.count("sidemap_throttled_total", host=host, status=status)
+                if attempt < self.retries:
+                    self._retried(host)
+                    # waits for the pause of the host in acquire
+                    continue
+            else:
+                self.release(host, time.monotonic() - start, "ok")
+            if error != None:
+                raise error
+            return (status, headers, payload)
+
+    def _retried(self, host: str) -> None:
+        with self._condition:
+            self._host(host).retries += 1
+        metrics.registry.count("sidemap_retries_total", host=host)
+
+    ## state
+
+    # {host: {"concurrency": , "inFlight": , "requestsPerSecond": , "latency": , "requests": , "errors": , "throttled": , "retries": }}
+    def rates(self) -> {}:
+        with self._condition:
+            now = time.monotonic()
+            return {host: {"concurrency": state.concurrency, "inFlight": state.inFlight, "requestsPerSecond": sum(1 for completion in state.completions if completion >= now - rateWindow) / rateWindow, "latency": state.latency, "requests": state.requests, "errors": state.errors, "throttled": state.throttled, "retries": state.retries} for host, state in self._hosts.items()}
+
+
+## helpers
+
+# seconds to wait before the retry after the given attempt, drawn between 0 and an exponential bound
+def backoff(attempt: int) -> float:
+    return random.uniform(0, min(backoffCap, backoffBase * 2 ** attempt))
+
+# whether the request may succeed if sent again: timeout, refused, reset or cut connection
+def isTransient(error: Exception) -> bool:
+    # urlopen wraps the connection errors
+    reason = error.reason if isinstance(error, URLError) and isinstance(error.reason, Exception) else error
+    return isinstance(reason, (TimeoutError, ConnectionError, http.client.IncompleteRead))
+
+# seconds asked by the Retry-After header (seconds or HTTP date), None if missing or invalid
+def retryAfter(headers: object) -> float:
+    value = None if headers == None else headers.get("Retry-After")
+    if value == None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0), maxRetryAfter)
+
+# Crawl-delay of the robots.txt group applying to every user agent (*), None if not given
+def robotsCrawlDelay(robotsCode: str) -> float:
+    agents = []
+    inRules = False
+    for line in robotsCode.splitlines():
+        name, separator, value = line.split("#")[0].partition(":")
+        name, value = name.strip().lower(), value.strip()
+        if separator == "":
+            continue
+        if name == "user-agent":
+            # a user agent line after rules starts a new group
+            if inRules:
+                agents = []
+                inRules = False
+            agents.append(value)
+        else:
+            inRules = True
+            if name == "crawl-delay" and "*" in agents:
+                try:
+                    return float(value)
+                except ValueError:
+                    return None
+    return None
+
+# requests of the running crawl to every host, shared by the prober, the sitemaps and the crawl engines
+controller = RateController()
@@ -0,0 +1,278 @@
+import crawler
+import graphstore
+import hashlib
+import json
+import multiprocessing
+import ratecontrol
+import sitemap
+import sqlite3
+import time
+import url as urlmod
+import utils
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from glob import glob
+from os import path, makedirs, remove, replace
+from urllib.parse import urlsplit
+
+# files of the shard directory, shared by the coordinator and the workers (eg. on a network filesystem)
+queueName = "queue.sqlite"
+shardName = "shard-{}.jsonl"
+# seconds between two checks of the queue by an idle worker or the coordinator
+pollInterval = 0.2
+# seconds waited for the queue by a worker started before the coordinator, and for a locked queue
+queueTimeout = 60
+# URLs claimed at once by a worker, per worker thread
+claimedPerWorker = 2
+# times a local worker stopped before the end of the crawl is started again
+workerRestarts = 3
+# states of the URLs of the queue
+pendingState = 0
+claimedState = 1
+doneState = 2
+
+
+class WorkQueue:
+    """Class that keeps the URLs to visit of a sharded crawl in a SQLite file: each URL belongs to the shard of its hash,
+    and the URLs of a depth are only claimed once every URL of the previous depth is done, so depths are the serial ones"""
+
+    ### methods
+
+    ## constructor
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self._settings = None
+        self._connection = sqlite3.connect(filename, timeout=queueTimeout, isolation_level=None)
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, shard INTEGER, depth INTEGER, forms TEXT, state INTEGER);
+            CREATE INDEX IF NOT EXISTS urlsToClaim ON urls (state, shard, depth);
+            CREATE INDEX IF NOT EXISTS urlsLevel ON urls (state, depth);
+            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+        """)
+
+    # new queue of the crawl, with the root URL and the seeds (eg. from sitemap.addSitemaps)
+    @classmethod
+    def create(cls, filename: str, shards: int, maxDepth: int, banExts: [], rootUrl: urlmod.URL, seeds: [] = []) -> "WorkQueue":
+        for oldFilename in [filename, filename + "-journal", filename + ".tmp", filename + ".tmp-journal"]:
+            if path.isfile(oldFilename):
+                remove(oldFilename)
+        # written aside then moved, so a waiting worker never opens a queue without its settings
+        queue = cls(filename + ".tmp")
+        with queue._transaction():
+            queue._connection.executemany("INSERT INTO settings VALUES (?, ?)", [("shards", json.dumps(shards)), ("maxDepth", json.dumps(maxDepth)), ("banExts", json.dumps(banExts)), ("rootUrl", json.dumps(rootUrl.forms())), ("maxPageSize", json.dumps(utils.maxPageSize))])
+        queue.add([(rootUrl, 0)] + [(seedUrl, max(depth, 0)) for seedUrl, depth in seeds])
+        queue.close()
+        replace(filename + ".tmp", filename)
+        return cls(filename)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    # the file is locked from the start to the end of the block
+    @contextmanager
+    def _transaction(self):
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+    # {"shards": , "maxDepth": , "banExts": , "rootUrl": forms, "maxPageSize": } of the crawl
+    def settings(self) -> {}:
+        if self._settings == None:
+            self._settings = {key: json.loads(value) for key, value in self._connection.execute("SELECT key, value FROM settings")}
+        return self._settings
+
+    ## queue
+
+    # queues the [(url, depth), ...] not seen yet and closer than the maximum depth, the first depth of a URL is kept
+    def add(self, urlsAndDepths: []) -> None:
+        with self._transaction():
+            self._add(urlsAndDepths)
+
+    def _add(self, urlsAndDepths: []) -> None:
+        settings = self.settings()
+        rows = [(url.url, shardOf(url.url, settings["shards"]), depth, json.dumps(url.forms()), pendingState) for url, depth in urlsAndDepths if depth < settings["maxDepth"]]
+        self._connection.executemany("INSERT OR IGNORE INTO urls VALUES (?, ?, ?, ?, ?)", rows)
+
+    # claims at most limit pending URLs of the shard at the depth being visited, returns [(url, depth), ...]
+    def claim(self, shard: int, limit: int) -> []:
+        with self._transaction():
+            level = self._level()
+            if level == None:
+                return []
+            rows = self._connection.execute("SELECT url, forms FROM urls WHERE state = ? AND shard = ? AND depth = ? LIMIT ?", (pendingState, shard, level, limit)).fetchall()
+            self._connection.executemany("UPDATE urls SET state = ? WHERE url = ?", [(claimedState, row[0]) for row in rows])
+        return [(urlmod.fromForms(json.loads(forms)), level) for pageUrl, forms in rows]
+
+    # marks the visited URLs as done and queues the URLs found on them
+    def finish(self, visitedUrls: [], foundUrlsAndDepths: []) -> None:
+        with self._transaction():
+            self._add(foundUrlsAndDepths)
+            self._connection.executemany("UPDATE urls SET state = ? WHERE url = ?", [(doneState, url.url) for url in visitedUrls])
+
+    # URLs claimed by a stopped worker of the shard are visited again by the next one
+    def releaseClaims(self, shard: int) -> None:
+        with self._transaction():
+            self._connection.execute("UPDATE urls SET state = ? WHERE state = ? AND shard = ?", (pendingState, claimedState, shard))
+
+    # depth being visited, None once every URL is done
+    def _level(self) -> int:
+        return self._connection.execute("SELECT MIN(depth) FROM urls WHERE state != ?", (doneState,)).fetchone()[0]
+
+    def isDone(self) -> bool:
+        return self._level() == None
+
+    # (depth being visited or None, URLs done, URLs queued)
+    def progress(self) -> (int, int, int):
+        done, queued = self._connection.execute("SELECT SUM(state = ?), COUNT(*) FROM urls", (doneState,)).fetchone()
+        return (self._level(), done or 0, queued)
+
+
+## sharding
+
+# shard of the URL, the same in every process and on every machine (unlike hash())
+def shardOf(url: str, shards: int) -> int:
+    return int.from_bytes(hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest(), "big") % shards
+
+
+## worker
+
+# visits the URLs of the shard until the crawl is done, and writes {"url": , "reqs": [[href, link], ...] or None if not fetched}
+# for each of them in its shard file, the partial graph merged by mergeShards
+def runWorker(shardDir: str, shard: int, cookies: [] = [], workers: int = 8, verbosity: bool = False) -> int:
+    queueFilename = path.join(shardDir, queueName)
+    # workers started on other machines may wait for the coordinator
+    deadline = time.monotonic() + queueTimeout
+    while not(path.isfile(queueFilename)) and time.monotonic() < deadline:
+        time.sleep(pollInterval)
+    if not(path.isfile(queueFilename)):
+        raise FileNotFoundError("No crawl queue in " + shardDir + ", start the coordinator first")
+    queue = WorkQueue(queueFilename)
+    settings = queue.settings()
+    queue.releaseClaims(shard)
+    # pages are read up to the size given to the coordinator
+    utils.maxPageSize = settings["maxPageSize"]
+    # the shards share the crawl delay asked by the website
+    rootUrl = urlmod.fromForms(settings["rootUrl"])
+    crawlDelay = ratecontrol.robotsCrawlDelay(sitemap.fetchRobots(rootUrl, cookies))
+    if crawlDelay != None:
+        ratecontrol.controller.setCrawlDelay(urlsplit(rootUrl.url).netloc, crawlDelay * settings["shards"])
+    pool = crawler.ConnectionPool()
+    visitedPages = 0
+    start = time.perf_counter()
+
+    # returns the requests found on the page (None if it cannot be fetched) and the pages to map among them
+    def visit(url: urlmod.URL) -> ([], []):
+        if not(url.isUrl()):
+            return (None, [])
+        try:
+            pageCode = pool.doRequest(url.url, cookies=cookies)
+        except:
+            utils.printVerb(verbosity, 'R', "[-] URL " + url.url + " is not recognized")
+            return (None, [])
+        try:
+            urlsAndReqs = crawler.findPageReqs(url, pageCode)
+        except:
+            utils.printVerb(verbosity, 'R', "[-] URL " + url.url + " could not be parsed")
+            return (None, [])
+        foundUrls = [urlmod.URL(urlAndReq[0], refUrl=url) for urlAndReq in urlsAndReqs]
+        return (urlsAndReqs, [foundUrl for foundUrl in foundUrls if foundUrl.isUrl() and crawler.isPageToMap(url, foundUrl, settings["banExts"])])
+
+    with open(path.join(shardDir, shardName.format(shard)), "a") as records, ThreadPoolExecutor(max_workers=workers) as executor:
+        # ends the line cut by a stopped worker of the shard
+        if records.tell() > 0:
+            records.write("\n")
+        while True:
+            claimed = queue.claim(shard, claimedPerWorker * workers)
+            if claimed == []:
+                if queue.isDone():
+                    break
+                time.sleep(pollInterval)
+                continue
+
+            foundUrlsAndDepths = []
+            for (url, depth), (urlsAndReqs, foundUrls) in zip(claimed, executor.map(visit, [url for url, depth in claimed])):
+                records.write(json.dumps({"url": url.url, "reqs": urlsAndReqs}, separators=(",", ":")) + "\n")
+                if urlsAndReqs != None:
+                    visitedPages += 1
+                foundUrlsAndDepths += [(foundUrl, depth + 1) for foundUrl in foundUrls]
+            # the records are on the disk before their URLs are done
+            records.flush()
+            queue.finish([url for url, depth in claimed], foundUrlsAndDepths)
+
+    pool.close()
+    queue.close()
+    utils.printVerb(verbosity, 'G', "[+] Shard " + str(shard) + ": " + str(visitedPages) + " pages visited in " + "{:.2f}".format(time.perf_counter() - start) + "s")
+    return visitedPages
+
+
+## coordinator
+
+# sharded engine: the URLs are shared by hash between shards worker processes through a queue in shardDir, the first localWorkers
+# shards are visited by processes of this machine (the others by "sidemap.py --worker" on other machines), then the shard files are merged
+def crawlSharded(graph: graphstore.GraphStore, rootUrl: urlmod.URL, maxDepth: int, banExts: [], cookies: [] = [], verbosity: bool = False, workers: int = 8, seeds: [] = [], shards: int = 2, shardDir: str = "shards", localWorkers: int = None) -> graphstore.GraphStore:
+    makedirs(shardDir, exist_ok=True)
+    for shardFilename in glob(path.join(shardDir, shardName.format("*"))):
+        remove(shardFilename)
+    queue = WorkQueue.create(path.join(shardDir, queueName), shards, maxDepth, banExts, rootUrl, seeds)
+    localWorkers = shards if localWorkers == None else min(localWorkers, shards)
+    processes = {shard: multiprocessing.Process(target=runWorker, args=(shardDir, shard, cookies, workers, verbosity)) for shard in range(localWorkers)}
+    for process in processes.values():
+        process.start()
+    restarts = {shard: 0 for shard in processes}
+
+    level = 0
+    while not(queue.isDone()):
+        time.sleep(pollInterval)
+        progress = queue.progress()
+        if progress[0] != level and progress[0] != None:
+            level = progress[0]
+            utils.printVerb(verbosity, 'G', "[+] " + str(progress[1]) + " of " + str(progress[2]) + " URLs visited, now at depth " + str(level))
+        # a local worker stopped before the end (crashed or killed) is started again, its claimed URLs are visited by the new one
+        for shard, process in list(processes.items()):
+            if process.exitcode == None or queue.isDone():
+                continue
+            if restarts[shard] == workerRestarts:
+                for otherProcess in processes.values():
+                    otherProcess.terminate()
+                queue.close()
+                raise RuntimeError("The worker of shard " + str(shard) + " stopped " + str(workerRestarts + 1) + " times before the end of the crawl (exit code " + str(process.exitcode) + "), see " + shardDir)
+            restarts[shard] += 1
+            utils.printVerb(verbosity, 'Y', "[!] The worker of shard " + str(shard) + " stopped (exit code " + str(process.exitcode) + "), starting it again")
+            processes[shard] = multiprocessing.Process(target=runWorker, args=(shardDir, shard, cookies, workers, verbosity))
+            processes[shard].start()
+    for process in processes.values():
+        process.join()
+    queue.close()
+    return mergeShards(graph, rootUrl, maxDepth, banExts, shardDir, verbosity, seeds)
+
+# replays the serial crawl with the pages of the shard files instead of fetching them, so the graph is the serial one
+def mergeShards(graph: graphstore.GraphStore, rootUrl: urlmod.URL, maxDepth: int, banExts: [], shardDir: str, verbosity: bool = False, seeds: [] = []) -> graphstore.GraphStore:
+    # {url: [[href, link], ...] or None}, the last record of a page visited twice (by a restarted worker) is kept
+    pages = {}
+    shardFilenames = sorted(glob(path.join(shardDir, shardName.format("*"))))
+    for shardFilename in shardFilenames:
+        with open(shardFilename, "r") as records:
+            for line in records:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # empty line, or line cut by a stopped worker
+                    continue
+                pages[record["url"]] = record["reqs"]
+
+    toVisitUrls = crawler.seededFrontier(rootUrl, seeds)
+    for url in toVisitUrls:
+        graph.addOutOfScopeURL("recap", url.page)
+        if toVisitUrls.depth < maxDepth and url.isUrl():
+            graph.addNode(url.page)
+            urlsAndReqs = pages.get(url.url)
+            if urlsAndReqs == None:
+                continue
+            for foundUrl in crawler.addPageLinks(graph, url, urlsAndReqs, banExts, verbosity):
+                toVisitUrls.add(foundUrl)
+    utils.printVerb(verbosity, 'G', "[+] " + str(len(pages)) + " pages of " + str(len(shardFilenames)) + " shards merged")
+    return graph
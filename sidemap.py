@@ -1,9 +1,19 @@
 import argparse
-import ast
+import cache
+import crawler
+import export
+import graphstore
+import metrics
+import prober
+import ratecontrol
+import shard
 import url as urlmod
 import utils
 from os import path, makedirs
 import re
+import sys
+from urllib.parse import urlsplit
+import sitemap
 
 def main():
     parser = argparse.ArgumentParser()
@@ -18,10 +28,34 @@ def main():
     parser.add_argument("-cr", "--cache-results", default=False, help="puts the result in a cache file", action=argparse.BooleanOptionalAction)
     parser.add_argument("-cf", "--cache-file", default=False, help="uses the appropriate cache file to load graph", action=argparse.BooleanOptionalAction)
     parser.add_argument("-c", "--cookie", default=[], help="space separated list of cookies to include to the request", nargs='+')
+    parser.add_argument("-w", "--workers", default=1, help="number of pages fetched concurrently (1 crawls serially)")
+    parser.add_argument("-wl", "--wordlist", default=None, help="file of known pages to probe, one path per line")
+    parser.add_argument("-rv", "--revalidate", default=True, help="with cache results, only parses the pages changed since the previous crawl", action=argparse.BooleanOptionalAction)
+    parser.add_argument("-pw", "--probe-workers", default=16, help="number of known pages probed concurrently")
+    parser.add_argument("-sm", "--sitemaps", default=True, help="visits the pages listed in the sitemaps (robots.txt Sitemap lines and sitemap.xml)", action=argparse.BooleanOptionalAction)
+    parser.add_argument("-p", "--parsers", default=0, help="number of processes extracting the links while the pages are fetched (0 extracts them in the crawling process)")
+    parser.add_argument("-l", "--large", default=False, help="gathers the pages by hostname and directory to display large graphs", action=argparse.BooleanOptionalAction)
+    parser.add_argument("-mn", "--max-nodes", default=500, help="maximum number of nodes displayed with --large")
+    parser.add_argument("-o", "--output", default=None, help="writes the graph in a GraphML (.graphml), JSON lines (.jsonl) or DOT (.dot, .gv) file, compressed if it ends with .gz, or on the standard output with -")
+    parser.add_argument("-of", "--output-format", default=None, choices=["graphml", "jsonl", "dot"], help="format of the output, guessed from its extension by default")
+    parser.add_argument("-di", "--display", default=True, help="displays the graph in the browser", action=argparse.BooleanOptionalAction)
+    parser.add_argument("-me", "--metrics", default=None, help="writes the metrics of the run in METRICS.json and METRICS.prom (Prometheus text format)")
+    parser.add_argument("-mi", "--metrics-interval", default=0, help="with --metrics, also writes the metrics every given seconds during the run")
+    parser.add_argument("-r", "--retries", default=ratecontrol.defaultRetries, help="retries of a throttled (429, 503) or failed request, after a jittered backoff or the Retry-After delay")
+    parser.add_argument("-to", "--timeout", default=ratecontrol.defaultTimeout, help="seconds before a request without response fails")
+    parser.add_argument("-ms", "--max-size", default=utils.maxPageSize, help="bytes of a page read at most, the rest is ignored (responses which are not HTML pages are never read)")
+    parser.add_argument("-sh", "--shards", default=0, help="number of worker processes sharing the URLs by hash through a queue in --shard-dir (0 crawls in this process)")
+    parser.add_argument("-sd", "--shard-dir", default=None, help="directory of the queue and of the pages found by each shard, on a filesystem shared by the machines of the crawl")
+    parser.add_argument("-lw", "--local-workers", default=None, help="with --shards, number of shards visited by this machine, the others by --worker on other machines (all by default)")
+    parser.add_argument("-wk", "--worker", default=None, help="only visits the given shard of the crawl started in --shard-dir by another sidemap, then exits")
 
     args = parser.parse_args()
 
-    toVisitUrls = [urlmod.URL(str(args.url), isRef=True)]
+    # the format of the output is checked before crawling
+    if args.output != None and args.output_format == None and export.guessFormat(args.output) == None:
+        parser.error("unknown format of the output " + args.output + ", use --output-format or the .graphml, .jsonl or .dot extension")
+
+    rootUrl = urlmod.URL(str(args.url), isRef=True)
     maxDepth = int(args.depth)
     verbosity = bool(args.verbose)
     tree = bool(args.tree)
@@ -31,106 +65,140 @@ def main():
     banExts = args.banexts
     cacheResult = bool(args.cache_results)
     cacheFile = bool(args.cache_file)
+    revalidate = bool(args.revalidate)
     cacheDir = "cache"
-    cacheFilename = re.sub("/", "_", toVisitUrls[0].page)+'.cache'
+    cacheName = re.sub("/", "_", rootUrl.page)
     cookies = args.cookie
-
-    wellKnowns = [urlmod.URL(knownPage, refUrl=toVisitUrls[0]) for knownPage in ["robots.txt", "security.txt", "sitemap.xml", "xmlrpc.php", "wp-admin/login.php", "wp-admin/wp-login.php", "login.php", "wp-login.php", "admin"]]
-    graph = {"recap": {"links": [], "outOfScopeURLs": [], "internal": {"nodeSize": 10}}, "known pages": {"links": [], "outOfScopeURLs": [], "internal": {"nodeSize": 2}}, toVisitUrls[0].page: {"links": [{"page": "known pages", "params": [], "method": "GET", "edgeSize": 2}], "outOfScopeURLs": [], "internal": {"nodeSize": 2}}}
-    depth = 0
-    sizeToVisitUrl = len(toVisitUrls)
+    workers = int(args.workers)
+    probeWorkers = int(args.probe_workers)
+    parsers = int(args.parsers)
+    sitemaps = bool(args.sitemaps)
+    large = bool(args.large)
+    maxNodes = int(args.max_nodes)
+    output = args.output
+    outputFormat = args.output_format
+    display = bool(args.display)
+    metricsPrefix = args.metrics
+    metricsInterval = float(args.metrics_interval)
+    retries = int(args.retries)
+    timeout = float(args.timeout)
+    utils.maxPageSize = int(args.max_size)
+    shards = int(args.shards)
+    shardDir = args.shard_dir if args.shard_dir != None else path.join(cacheDir, cacheName + ".shards")
+    localWorkers = None if args.local_workers == None else int(args.local_workers)
+
+    # the messages are kept out of the graph written on the standard output
+    if output == "-":
+        utils.verboseStream = sys.stderr
+
+    wellKnowns = [urlmod.URL(knownPage, refUrl=rootUrl) for knownPage in (prober.readWordlist(args.wordlist) if args.wordlist else prober.defaultWellKnowns)]
+    graph = {"recap": {"links": [], "outOfScopeURLs": [], "internal": {"nodeSize": 10}}, "known pages": {"links": [], "outOfScopeURLs": [], "internal": {"nodeSize": 2}}, rootUrl.page: {"links": [{"page": "known pages", "params": [], "method": "GET", "edgeSize": 2}], "outOfScopeURLs": [], "internal": {"nodeSize": 2}}}
+
+    if cacheResult and not(path.isdir(cacheDir)):
+        makedirs(cacheDir)
+
+    if metricsPrefix != None and metricsInterval > 0:
+        metrics.registry.startExporting(metricsPrefix, metricsInterval)
+
+    # every host is requested at most as many times at once as there are workers, fewer while it slows down or throttles
+    ratecontrol.controller.configure(maxConcurrency=max(workers, probeWorkers), retries=retries, timeout=timeout)
+
+    # other machine of a sharded crawl
+    if args.worker != None:
+        shard.runWorker(shardDir, int(args.worker), cookies, workers, verbosity)
+        if metricsPrefix != None:
+            metrics.registry.stopExporting()
+            metrics.registry.export(metricsPrefix)
+        return
 
     if not(cacheFile):
-        # well known pages
-        for wellKnown in wellKnowns:
-            try:
-                statusCode = utils.getStatusCode(wellKnown.url)
-            except:
-                utils.printVerb(verbosity, 'R', "[-] Error with the URL " + wellKnown.url)
-                continue
+        # crawl delay asked by the website, its sitemaps are read below
+        robotsCode = sitemap.fetchRobots(rootUrl, cookies)
+        crawlDelay = ratecontrol.robotsCrawlDelay(robotsCode)
+        if crawlDelay != None:
+            ratecontrol.controller.setCrawlDelay(urlsplit(rootUrl.url).netloc, crawlDelay)
+            utils.printVerb(verbosity, 'Y', "[!] Waiting " + str(crawlDelay) + " seconds between requests as asked by robots.txt")
+
+        # the graph is kept compact while crawling, and written in the cache file as it grows
+        journal = cache.CacheWriter(path.join(cacheDir, cacheName+'.jsonl')) if cacheResult else None
+        graph = graphstore.GraphStore.fromDict(graph, journal)
+        # validators of the visited pages, to revalidate them on the next crawl
+        validators = cache.PageValidators(path.join(cacheDir, cacheName+'.validators.jsonl')) if cacheResult and revalidate and shards == 0 else None
 
-            # if page exists
-            if statusCode == 200:
-                utils.printVerb(verbosity, 'G', "[+] Found known page " + wellKnown.url)
+        # well known pages
+        with metrics.registry.timer("sidemap_stage_seconds", stage="probe"):
+            graph = prober.addKnownPages(graph, prober.probe(wellKnowns, cookies, probeWorkers), verbosity)
 
-                # add to the recap and known pages
-                graph["recap"]["outOfScopeURLs"].append(wellKnown.page)
-                graph["known pages"]["outOfScopeURLs"].append(wellKnown.page)
+        # pages listed in the sitemaps
+        seeds = []
+        if sitemaps:
+            with metrics.registry.timer("sidemap_stage_seconds", stage="sitemaps"):
+                seeds = sitemap.addSitemaps(graph, rootUrl, banExts, cookies, verbosity, robotsCode)
 
-                # create and link a new node for the known page
-                graph[wellKnown.page] = {"links": [], "outOfScopeURLs": [], "internal": {"nodeSize": 2}}
-                graph["known pages"]["links"].append({"page": wellKnown.page, "params": [], "method": "GET", "edgeSize": 2})
+        # other URL on the page
+        with metrics.registry.timer("sidemap_stage_seconds", stage="crawl"):
+            if shards > 0:
+                graph = shard.crawlSharded(graph, rootUrl, maxDepth, banExts, cookies, verbosity, workers, seeds, shards, shardDir, localWorkers)
+            elif parsers > 0:
+                graph = crawler.crawlPipelined(graph, rootUrl, maxDepth, banExts, cookies, verbosity, workers, parsers, validators, seeds)
+            elif workers > 1:
+                graph = crawler.crawlConcurrent(graph, rootUrl, maxDepth, banExts, cookies, verbosity, workers, validators, seeds)
+            else:
+                graph = crawler.crawl(graph, rootUrl, maxDepth, banExts, cookies, verbosity, validators, seeds)
 
-                # increase known pages node degree
-                graph["known pages"]["internal"]["nodeSize"] += 1
+        utils.printVerb(verbosity, 'G', "[+] " + str(int(metrics.registry.total("sidemap_transferred_bytes_total"))) + " bytes received for " + str(int(metrics.registry.total("sidemap_response_bytes"))) + " bytes of pages, " + str(int(metrics.registry.total("sidemap_skipped_pages_total"))) + " responses skipped as not pages, " + str(int(metrics.registry.total("sidemap_truncated_pages_total"))) + " pages truncated")
+        for host, rate in ratecontrol.controller.rates().items():
+            utils.printVerb(verbosity, 'G', "[+] " + host + ": " + str(rate["requests"]) + " requests, " + str(round(rate["concurrency"], 1)) + " at once, " + str(rate["throttled"]) + " throttled, " + str(rate["errors"]) + " failed, " + str(rate["retries"]) + " retried")
 
-            else:
-                utils.printVerb(verbosity, 'Y', "[-] Known page " + wellKnown.url + " returned " + str(statusCode))            
+        if validators != None:
+            validators.close()
+            utils.printVerb(verbosity, 'G', "[+] " + validators.summary())
 
-        # other URL on the page
-        for url in toVisitUrls:
-            graph["recap"]["outOfScopeURLs"].append(url.page)
-
-            if(depth < maxDepth and url.isUrl()):
-                if not(url.page in graph): graph[url.page] = {"links": [], "outOfScopeURLs": [], "internal": {"nodeSize": 1}}
-                utils.printVerb(verbosity, 'W', "On page " + url.url)
-                # get page code
-                try:
-                    pageCode = utils.doRequest(url.url, cookies=cookies)
-                except:
-                    utils.printVerb(verbosity, 'R', "[-] URL " + url.url + " is not recognized")
-                    continue
-                
-                # find urls
-                urlsAndReqs = urlmod.findReqs(pageCode, url)
-
-                for urlAndReq in urlsAndReqs:
-                    foundUrl = urlmod.URL(urlAndReq[0], refUrl=url)
-                    foundReq = urlAndReq[1]
-
-                    if foundUrl.isUrl():
-                        # foundUrl is from a website to map
-                        if utils.isInScope(url.domain, foundUrl.domain) and not(foundUrl.getExtension() in banExts):
-                            utils.printVerb(verbosity, 'G', "[+] Found a new page to map " + foundUrl.url)
-                            graph[url.page]["links"].append(foundReq)
-                            # increase degree of the target node
-                            graph = utils.increaseNodeDegree(foundUrl.page, graph, foundReq["edgeSize"])
-                            # add the found URL to the list of URL to visit
-                            if not(foundUrl in toVisitUrls): 
-                                toVisitUrls.append(foundUrl)
-                        
-                        else:
-                            # foundUrl is not from a website to map or is a file that cannot be read (eg. picture)
-                            # add foundURL to url's props
-                            utils.printVerb(verbosity, 'G', "[+] Found property page " + foundUrl.url)
-                            if not(foundUrl.page in graph[url.page]["outOfScopeURLs"]): graph[url.page]["outOfScopeURLs"].append(foundUrl.page)
-
-                if(toVisitUrls.index(url)+1 == sizeToVisitUrl):
-                    depth += 1
-                    sizeToVisitUrl = len(toVisitUrls)
-
-                graph[url.page]["internal"]["nodeSize"] += len(graph[url.page]["links"])
-        
-        graph["recap"]["outOfScopeURLs"] = sorted(list(set(graph["recap"]["outOfScopeURLs"])), key=str.lower)
+        graph.setOutOfScopeURLs("recap", sorted(graph.getOutOfScopeURLs("recap"), key=str.lower))
+        if journal != None: journal.close()
 
     else:
-        try:
-            with open(path.join(cacheDir, cacheFilename), "r") as cf:
-                graph = ast.literal_eval(cf.read())
-        except:
-            print("Cache file not found")
-
-    if cacheResult:
-        if not(path.isdir(cacheDir)):
-            makedirs(cacheDir)
-        with open(path.join(cacheDir, cacheFilename), 'w') as cf:
-            cf.write(str(graph))
-
-    graph = utils.computeGlobalLinkSize(graph)
-    graph = utils.colorNodes(graph)
-    graph = utils.colorEdges(graph, toVisitUrls[0].page)
-    g = utils.makeNXGraph(graph)
-    utils.drawGravis(g, dim, tree, xcoef, ycoef)
+        with metrics.registry.timer("sidemap_stage_seconds", stage="load"):
+            try:
+                graph = cache.load(cacheDir, cacheName)
+            except:
+                print("Cache file not found", file=utils.verboseStream)
+
+        # rewrites the loaded graph in the current format
+        if cacheResult:
+            cache.save(graph, path.join(cacheDir, cacheName+'.jsonl'))
+
+    # the crawled graph stays compact for the export, the graph of dicts is only built to gather or display it
+    if isinstance(graph, graphstore.GraphStore) and (large or display):
+        graph = graph.toDict()
+    if not(isinstance(graph, graphstore.GraphStore)):
+        with metrics.registry.timer("sidemap_stage_seconds", stage="computeGlobalLinkSize"):
+            graph = utils.computeGlobalLinkSize(graph)
+    root = rootUrl.page
+    if large:
+        with metrics.registry.timer("sidemap_stage_seconds", stage="clusterGraph"):
+            graph, clusters = utils.clusterGraph(graph, maxNodes)
+        root = clusters.get(root, root)
+        utils.printVerb(verbosity, 'G', "[+] " + str(len(clusters)) + " pages gathered in " + str(len(graph)) + " nodes")
+
+    # the graph is written as is, without building the displayed one (the link sizes of a GraphStore are computed while writing it)
+    if output != None:
+        with metrics.registry.timer("sidemap_stage_seconds", stage="export"):
+            export.exportGraph(graph, output, outputFormat)
+
+    if display:
+        with metrics.registry.timer("sidemap_stage_seconds", stage="colorNodes"):
+            graph = utils.colorNodes(graph)
+        with metrics.registry.timer("sidemap_stage_seconds", stage="colorEdges"):
+            graph = utils.colorEdges(graph, root)
+        with metrics.registry.timer("sidemap_stage_seconds", stage="makeNXGraph"):
+            g = utils.makeNXGraph(graph)
+        with metrics.registry.timer("sidemap_stage_seconds", stage="drawGravis"):
+            utils.drawGravis(g, dim, tree, xcoef, ycoef, root)
+
+    if metricsPrefix != None:
+        metrics.registry.stopExporting()
+        metrics.registry.export(metricsPrefix)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,177 @@
+import crawler
+import graphstore
+import gzip
+import io
+import url as urlmod
+import utils
+import zlib
+from collections import deque
+from urllib.parse import urljoin
+from xml.etree import ElementTree
+
+# depth of the URLs found in the sitemaps, which are one hop away from the root like the known pages
+sitemapDepth = 1
+# maximum number of sitemap files read for one crawl, sitemap indexes may list a lot of them or each other
+maxSitemaps = 1000
+# bytes of a sitemap read at most (decompressed), the limit of the sitemaps protocol
+maxSitemapSize = 50 * 1024 * 1024
+
+
+class CappedStream(io.RawIOBase):
+    """Class that reads a stream as if it ended after maxSize bytes"""
+
+    ### methods
+
+    ## constructor
+    def __init__(self, stream, maxSize: int) -> None:
+        self._stream = stream
+        self._remaining = maxSize
+        # True once the stream had bytes beyond maxSize
+        self.truncated = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self._remaining <= 0:
+            self.truncated = self.truncated or self._stream.read(1) != b""
+            return 0
+        data = self._stream.read(min(len(buffer), self._remaining))
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+
+## parsing
+
+# URLs of the "Sitemap:" lines of a robots.txt file
+def robotsSitemaps(robotsCode: str) -> []:
+    sitemaps = []
+    for line in robotsCode.splitlines():
+        name, separator, value = line.partition(":")
+        if separator != "" and name.strip().lower() == "sitemap" and value.strip() != "":
+            sitemaps.append(value.strip())
+    return sitemaps
+
+# yields ("url", location) of a sitemap or ("sitemap", location) of a sitemap index while reading the stream,
+# a gzip sitemap is decompressed on the fly and a text sitemap (one URL per line) is read line by line,
+# with maxSize the sitemap is read as if it ended after maxSize bytes (decompressed)
+def iterSitemap(stream, maxSize: int = None) -> iter:
+    stream = io.BufferedReader(stream) if not(hasattr(stream, "peek")) else stream
+    if stream.peek(2)[:2] == b"\x1f\x8b":
+        stream = io.BufferedReader(gzip.GzipFile(fileobj=stream))
+    if maxSize != None:
+        cappedStream = CappedStream(stream, maxSize)
+        stream = io.BufferedReader(cappedStream)
+    if not(stream.peek(64).lstrip().startswith(b"<")):
+        for line in stream:
+            # the URL cut by maxSize is not kept
+            if maxSize != None and cappedStream.truncated and not(line.endswith(b"\n")):
+                return
+            line = line.decode("utf-8", errors="replace").strip()
+            if line != "":
+                yield ("url", line)
+        return
+
+    root = None
+    for event, element in ElementTree.iterparse(stream, events=("start", "end")):
+        if root == None:
+            root = element
+        if event == "end":
+            # tags without their namespace
+            tag = element.tag.rsplit("}", 1)[-1]
+            if tag == "url" or tag == "sitemap":
+                for child in element:
+                    if child.tag.rsplit("}", 1)[-1] == "loc" and child.text != None and child.text.strip() != "":
+                        yield (tag, child.text.strip())
+                # read entries are dropped to keep the memory constant
+                root.clear()
+
+
+# reader of ConnectionPool.get, returns ([(kind, location), ...], False if the sitemap is malformed or cut) of a sitemap response,
+# the sitemap is parsed while it is received and only its locations are kept (None for a redirection)
+def readSitemap(response) -> ([], bool):
+    if response.status >= 300:
+        return None
+    entries = []
+    try:
+        for entry in iterSitemap(response, maxSitemapSize):
+            entries.append(entry)
+    except (ElementTree.ParseError, EOFError, gzip.BadGzipFile, zlib.error):
+        return (entries, False)
+    return (entries, True)
+
+
+## robots.txt
+
+# code of the robots.txt file of the website, empty if it has none
+def fetchRobots(rootUrl: urlmod.URL, cookies: [] = []) -> str:
+    pool = crawler.ConnectionPool()
+    try:
+        status, responseHeaders, body = pool.get(urljoin(rootUrl.url, "/robots.txt"), {"User-Agent": utils.userAgent, "Cookie": "; ".join(cookies)})
+        return body.decode("utf-8", errors="replace")
+    except:
+        return ""
+    finally:
+        pool.close()
+
+
+## graph
+
+# reads the sitemaps of the website (listed in robots.txt, and sitemap.xml), adds each sitemap as a node linked to its URLs
+# and returns the in-scope URLs to visit as [(url, depth), ...], robots.txt is fetched if its code is not given
+def addSitemaps(graph: graphstore.GraphStore, rootUrl: urlmod.URL, banExts: [], cookies: [] = [], verbosity: bool = False, robotsCode: str = None) -> []:
+    pool = crawler.ConnectionPool()
+    headers = {"User-Agent": utils.userAgent, "Cookie": "; ".join(cookies)}
+    seeds = []
+    seenSeeds = set()
+
+    robotsHrefs = robotsSitemaps(fetchRobots(rootUrl, cookies) if robotsCode == None else robotsCode)
+    # (sitemap href, page of the node linking to it)
+    toReadSitemaps = deque((href, "known pages") for href in robotsHrefs + [urljoin(rootUrl.url, "/sitemap.xml")])
+    readSitemaps = set()
+
+    while toReadSitemaps and len(readSitemaps) < maxSitemaps:
+        sitemapHref, parentPage = toReadSitemaps.popleft()
+        if sitemapHref in readSitemaps:
+            continue
+        readSitemaps.add(sitemapHref)
+        try:
+            # the locations are kept until the response ends, so a request retried by the rate controller does not add them twice
+            status, responseHeaders, (entries, complete) = pool.get(sitemapHref, headers, readSitemap)
+        except:
+            utils.printVerb(verbosity, 'Y', "[-] No sitemap at " + sitemapHref)
+            continue
+        sitemapUrl = urlmod.URL(sitemapHref, refUrl=rootUrl)
+        utils.printVerb(verbosity, 'G', "[+] Reading sitemap " + sitemapUrl.url)
+
+        # the sitemap is a node linked from the known pages, or from its sitemap index
+        if not(graph.hasOutOfScopeURL(parentPage, sitemapUrl.page)):
+            graph.addOutOfScopeURL(parentPage, sitemapUrl.page)
+            graph.addLink(parentPage, {"page": sitemapUrl.page, "params": [], "method": "GET", "edgeSize": 2})
+            graph.increaseNodeDegree(sitemapUrl.page)
+            graph.increaseNodeSize(parentPage, 1)
+        graph.addOutOfScopeURL("recap", sitemapUrl.page)
+
+        links = 0
+        for kind, location in entries:
+            if kind == "sitemap":
+                toReadSitemaps.append((urljoin(sitemapHref, location), sitemapUrl.page))
+                continue
+            foundUrl = urlmod.URL(location, refUrl=sitemapUrl)
+            if foundUrl.isUrl() and utils.isInScope(rootUrl.domain, foundUrl.domain) and not(foundUrl.getExtension() in banExts):
+                graph.addLink(sitemapUrl.page, {"page": foundUrl.page, "params": foundUrl.params, "method": "GET", "edgeSize": 2})
+                graph.increaseNodeDegree(foundUrl.page)
+                links += 1
+                if not(foundUrl in seenSeeds):
+                    seenSeeds.add(foundUrl)
+                    seeds.append((foundUrl, sitemapDepth))
+            else:
+                graph.addOutOfScopeURL(sitemapUrl.page, foundUrl.page)
+        if not(complete):
+            utils.printVerb(verbosity, 'R', "[-] Sitemap " + sitemapUrl.url + " is malformed or too large, its first URLs are kept")
+        graph.increaseNodeSize(sitemapUrl.page, links)
+
+    pool.close()
+    utils.printVerb(verbosity, 'G', "[+] " + str(len(seeds)) + " pages to map found in the sitemaps")
+    return seeds
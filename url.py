@@ -1,8 +1,11 @@
-import re
 import validators
 import utils
+from functools import lru_cache
 from urllib.parse import unquote
-from bs4 import BeautifulSoup
+from html.parser import HTMLParser
+
+# maximum number of canonicalized URLs kept in memory
+canonicalCacheSize = 200000
 
 class URL:
     """Class that defines different forms and operations for a URL"""
@@ -21,16 +24,18 @@ class URL:
 
     ## constructor
     def __init__(self, url: str, refUrl: str = "", isRef: bool = False) -> None:
+        # relative URLs only depend on the hostname of their reference
+        url, page, hostname, domain, params = canonicalize(url, "" if isRef else refUrl.hostname, isRef)
         # http://hostname.domain.tld/pages/page.ext?key=value#
-        self.url = self._normalize(self._urlDecode(url), refUrl, isRef)
+        self.url = url
         # hostname.domain.tld/pages/page.ext
-        self.page = self._constructPage(self.url)
+        self.page = page
         # hostname.domain.tld
-        self.hostname = self._constructHostname(self.url)
+        self.hostname = hostname
         # domain.tld
-        self.domain = self._constructDomain(self.url)
+        self.domain = domain
         # ["key1=value1", "key2=value2"]
-        self.params = self._constructParams(self.url)
+        self.params = list(params)
 
     def __eq__(self, other): 
         if not isinstance(other, URL):
@@ -38,6 +43,14 @@ class URL:
 
         return self.url == other.url and self.page == other.page and self.hostname == other.hostname and self.domain == other.domain
 
+    # page, hostname and domain derive from url, which is thus enough as a key
+    def __hash__(self):
+        return hash(self.url)
+
+    # [url, page, hostname, domain, params], eg. to write the URL in a file
+    def forms(self) -> []:
+        return [self.url, self.page, self.hostname, self.domain, self.params]
+
     ## get info from url
 
     def isFile(self) -> bool:
@@ -49,94 +62,149 @@ class URL:
         return self.page.split('.')[-1]
     
     def isUrl(self) -> bool:
-        return validators.url(self.url)
-
-    def _isFile(self, url: str) -> bool:
-        urlParts = url.split('/')
-        if len(urlParts) >= 2:
-            return '.' in urlParts[-1]
-        return False
-
-    ## construct from url
-
-    # have '/' at the end if not a file
-    def _constructPage(self, url: str) -> str:
-        url = re.sub("^((http|https)://)", "", url).split("#")[0].split("?")[0]
-        url = utils.removeDots(url)
-        return url + ("" if (self._isFile(url) or url[-1] == "/") else "/")
-
-    # can not have '/' at the end
-    def _constructHostname(self, url: str) -> str:
-        return self._constructPage(url).split('/')[0]
-
-    # removes the first part of the given URL if there is more than domain.tld
-    # can not have '/' at the end
-    def _constructDomain(self, url: str) -> str:
-        parts = self._constructHostname(url).split('.')
-        return '.'.join(parts[1:]) if len(parts) > 2 else '.'.join(parts)
+        return isValidUrl(self.url)
+
+
+# URL of the forms [url, page, hostname, domain, params] of URL.forms (eg. read from a file), without canonicalizing it again
+def fromForms(forms: []) -> URL:
+    newUrl = URL.__new__(URL)
+    newUrl.url, newUrl.page, newUrl.hostname, newUrl.domain, newUrl.params = forms[0], forms[1], forms[2], forms[3], list(forms[4])
+    return newUrl
+
+
+## canonicalization
+
+@lru_cache(maxsize=canonicalCacheSize)
+def isValidUrl(url: str) -> bool:
+    return bool(validators.url(url))
+
+# parses the href once and returns (url, page, hostname, domain, params) of the URL
+# results are kept for the next URLs built from the same href and reference hostname
+@lru_cache(maxsize=canonicalCacheSize)
+def canonicalize(href: str, refHostname: str, isRef: bool) -> (str, str, str, str, ()):
+    # http://hostname.domain.tld/pages/page.ext?key=value#
+    url = _normalize(unquote(href), refHostname, isRef)
+    # hostname.domain.tld/pages/page.ext, have '/' at the end if not a file
+    page = utils.removeDots(utils.removeHttpScheme(url).split("#")[0].split("?")[0])
+    page = page + ("" if (_isFile(page) or page[-1] == "/") else "/")
+    # hostname.domain.tld, can not have '/' at the end
+    hostname = page.split('/')[0]
+    # domain.tld, removes the first part of the hostname if there is more than domain.tld
+    hostnameParts = hostname.split('.')
+    domain = '.'.join(hostnameParts[1:]) if len(hostnameParts) > 2 else hostname
+    # ("key1=value1", "key2=value2")
+    urlParts = url.split('?')
+    params = (" ",) if len(urlParts) == 1 else tuple(urlParts[1].split('&'))
+    return (url, page, hostname, domain, params)
+
+def _isFile(url: str) -> bool:
+    urlParts = url.split('/')
+    if len(urlParts) >= 2:
+        return '.' in urlParts[-1]
+    return False
+
+# Add the refURL if the found URL is a relative path
+def _normalize(url: str, refHostname: str, isRef: bool) -> str:
+    url = unquote(url)
+    url = utils.removeLastSpecialChar(url)
+    if isRef:
+        return utils.addScheme(url)
+    else:
+        # if relative reference
+        # WARNING: we suppose that pages to visit are always under the same hostname
+        # otherwise, we should adapt the prefix to the reference of the relative path
+        if utils.matchScheme(url) == None:
+            if url.startswith(refHostname):
+                return utils.addScheme(utils.removeStartSlash(url))
+            else:
+                return utils.addScheme(refHostname+"/"+utils.removeStartSlash(url))
+        elif url.startswith("//"):
+            return utils.addScheme(url[2:])
+        # if absolute reference
+        else:
+            return url
 
-    def _constructParams(self, url: str) -> []:
-        parts = url.split('?')
-        return [" "] if len(parts) == 1 else parts[1].split('&')
 
-    ## operations on url
+## search for url
 
-    def _urlDecode(self, string: str) -> str:
-        return unquote(string)
+# elements without content, closed as soon as opened
+voidTags = {"area", "base", "basefont", "bgsound", "br", "col", "command", "embed", "frame", "hr", "image", "img", "input", "isindex", "keygen", "link", "menuitem", "meta", "nextid", "param", "source", "spacer", "track", "wbr"}
 
-    # Add the refURL if the found URL is a relative path
-    def _normalize(self, url: str, ref, isRef: bool) -> str:
-        url = self._urlDecode(url)
-        url = utils.removeLastSpecialChar(url)
-        if isRef:
-            return utils.addScheme(url)
-        else:
-            # if relative reference
-            # WARNING: we suppose that pages to visit are always under the same hostname
-            # otherwise, we should adapt the prefix to the reference of the relative path
-            if utils.matchScheme(url) == None:
-                if url.startswith(ref.hostname):
-                    return utils.addScheme(utils.removeStartSlash(url))
-                else:
-                    return utils.addScheme(ref.hostname+"/"+utils.removeStartSlash(url))
-            elif url.startswith("//"):
-                return utils.addScheme(url[2:])
-            # if absolute reference
-            else:
-                return url
+class LinkExtractor(HTMLParser):
+    """Class that extracts the requests of a page in a single pass over its tags, the page can be fed by chunks"""
 
+    ### methods
 
-## search for url
+    ## constructor
+    def __init__(self, refUrl: URL, maxSize: int = None) -> None:
+        super().__init__()
+        self.refUrl = refUrl
+        # pages are parsed up to this number of characters, utils.maxPageSize (--max-size) by default
+        self.maxSize = utils.maxPageSize if maxSize == None else maxSize
+        self.size = 0
+        # found requests by tag, as they are returned in this order
+        self._aReqs = []
+        self._scriptReqs = []
+        self._formReqs = []
+        # [(tag, params if tag is a form else None), ...], elements not closed yet
+        self._openTags = []
+
+    ## parsing
+
+    def feed(self, data: str) -> None:
+        # ignore what is after the size limit
+        data = data[:max(self.maxSize - self.size, 0)]
+        self.size += len(data)
+        if data != "":
+            super().feed(data)
+
+    def handle_starttag(self, tag: str, attrs: []) -> None:
+        # valueless attributes are empty strings, the last duplicated attribute wins
+        attrs = {name: ("" if value == None else value) for name, value in attrs}
+        if not(tag in voidTags):
+            self._openTags.append((tag, [] if tag == "form" else None))
+        if tag == "a":
+            if attrs.get("href") == None: return
+            aUrl = URL(attrs["href"], refUrl=self.refUrl)
+            self._aReqs.append((attrs["href"], {"page": aUrl.page, "params": aUrl.params, "method": "GET", "edgeSize": 2}))
+        elif tag == "script":
+            if attrs.get("src") == None: return
+            self._scriptReqs.append((attrs["src"], {"page": URL(attrs["src"], refUrl=self.refUrl).page, "params": [" "], "method": "GET", "edgeSize": 2}))
+        elif tag == "form":
+            if attrs.get("action") == None: return
+            # method
+            method = "GET" if attrs.get("method") == None else attrs["method"].upper()
+            # params are filled while the inputs are found
+            self._formReqs.append((attrs["action"], method, self._openTags[-1][1]))
+        elif tag == "input":
+            # inputs belong to every opened form, nested forms included
+            for openTag, params in self._openTags:
+                if openTag == "form":
+                    params.append(str(attrs.get("name"))+"="+str(attrs.get("value")))
+
+    def handle_endtag(self, tag: str) -> None:
+        # closes the last opened element with this tag and every element opened inside it
+        for index in range(len(self._openTags) - 1, -1, -1):
+            if self._openTags[index][0] == tag:
+                del self._openTags[index:]
+                return
+
+    # returns [(url1, link1), (url2, link2), ...]
+    def close(self) -> []:
+        super().close()
+        rets = self._aReqs + self._scriptReqs
+        # construct dict (min edgeSize = 2, due to log in the computation of the representatin of the thickness)
+        for action, method, params in self._formReqs:
+            rets.append((action, {"page": URL(action, refUrl=self.refUrl).page, "params": [" "] if params == [] else params, "method": method, "edgeSize": 2}))
+        return rets
 
-def findReqs(page: str, refUrl: str) -> []:
-    soup = BeautifulSoup(page, features="html.parser")
+def findReqs(page: str, refUrl: str, maxSize: int = None) -> []:
+    extractor = LinkExtractor(refUrl, maxSize)
+    extractor.feed(page)
     # [{"page": "example.com", "params": ["key1=value1", "key2=value2"], "method": "GET", "edgeSize": 1}]
-    rets = []
-    # a tags
-    for a in soup.find_all('a'):
-        if a.get('href') == None: continue
-        aUrl = URL(a.get('href'), refUrl=refUrl)
-        rets.append((a.get('href'), {"page": aUrl.page, "params": aUrl.params, "method": "GET", "edgeSize": 2}))
-
-    # script sources
-    for script in soup.find_all('script'):
-        if script.get('src') == None: continue
-        rets.append((script.get('src'), {"page": URL(script.get('src'), refUrl=refUrl).page, "params": [" "], "method": "GET", "edgeSize": 2}))
-
-    # form tags
-    for form in soup.find_all('form'):
-        if form.get('action') == None: continue
-        # method
-        method = "GET" if form.get('method') == None else form.get('method').upper()
-        # params
-        params = []
-        inputs = form.findChildren('input')
-        for inp in inputs:
-            params.append(str(inp.get('name'))+"="+str(inp.get("value")))
-        # construct dict (min edgeSize = 2, due to log in the computation of the representatin of the thickness)
-        rets.append((form.get('action'), {"page": URL(form.get('action'), refUrl=refUrl).page, "params": [" "] if params == [] else params, "method": method, "edgeSize": 2}))
+    rets = extractor.close()
 
     # [(url1, link1), (url2, link2), ...]
     rets = utils.computeLinkSize(rets)
 
-    return rets
\ No newline at end of file
+    return rets
@@ -1,33 +1,60 @@
-from networkx.drawing.nx_agraph import graphviz_layout
 import networkx as nx
+import numpy as np
 from colorama import Fore
 import re
+from collections import Counter
 import gravis as gv
+import metrics
+import ratecontrol
+import time
+import zlib
 from math import log
+from urllib.parse import urlsplit
 from urllib.request import Request, urlopen, HTTPError
 
 # list of char to remove at the end of a URL
 lastSpecChar = "/#?"
+# gaps between two nodes of a same depth, and between two depths, of the tree layout
+treeNodeGap = 72
+treeLevelGap = 72
 # user agent used in the request
 userAgent = 'Mozilla/5.0 (Windows; U; Windows NT 6.0; en-GB; rv:1.9.0.5) Gecko/2008120122 Firefox/3.0.5'
+# types of the pages whose links are extracted, a response without Content-Type is read as a page
+htmlTypes = ("text/html", "application/xhtml+xml")
+# bytes of a page read at most (decompressed), the rest of the page is ignored
+maxPageSize = 10 * 1024 * 1024
+# skipped responses up to this size are read anyway, so that their connection can be reused
+drainSize = 16 * 1024
+readChunkSize = 64 * 1024
+# stream of the verbose messages, the standard output if None (the standard error when the graph is written there)
+verboseStream = None
+# charset of the <meta> tags at the start of a page without charset in its Content-Type
+metaCharsetRegex = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([A-Za-z0-9._:-]+)', re.IGNORECASE)
 
 
 ## operations on url
 
+schemeRegex = re.compile("^((http|https):)?//")
+httpSchemeRegex = re.compile("^((http|https)://)")
+startSlashRegex = re.compile("^/+")
+
 def matchScheme(url: str) -> str:
-    return re.match("^((http|https):)?//", url)
+    return schemeRegex.match(url)
 
 def addScheme(string: str) -> str:
     return string if matchScheme(string) != None else "https://"+string
 
 def removeScheme(url: str) -> str:
-    return re.sub("^((http|https):)?//", "", url)
+    return schemeRegex.sub("", url)
+
+def removeHttpScheme(url: str) -> str:
+    return httpSchemeRegex.sub("", url)
 
 def removeStartSlash(url: str) -> str:
-    return re.sub("^/+", "", url)
+    return startSlashRegex.sub("", url)
 
 def removeLastSpecialChar(string: str) -> str:
-    return string[:-1] if string[-1] in lastSpecChar else string
+    return string[:-1] if string != "" and string[-1] in lastSpecChar else string
 
 def isFile(string: str) -> bool:
     urlParts = string.split('/')
@@ -38,6 +65,9 @@ def getExtension(string: str) -> str:
     return string.split('.')[-1]
 
 def removeDots(string: str) -> str:
+    # no "." or ".." part
+    if not(string.startswith(".")) and not("/." in string):
+        return string
     # does not manage cases where ../ lead out of the domain 
     parts = string.split("/")
     for i in range(parts.count("..")):
@@ -58,35 +88,40 @@ def increaseNodeDegree(page: str, graph: {}, degree: int = 2) -> {}:
         graph[page] = {"links": [], "outOfScopeURLs": [], "internal": {"nodeSize": 2}}
     return graph
 
+# canonical key of a link, links with the same key are the same edge
+def edgeKey(link: {}) -> (str, str, ()):
+    return (link["page"], link["method"], tuple(sorted(link["params"])))
+
 def computeLinkSize(urlsAndLinks: []) -> []:
     # [(url1, links1), (url2, links2), ...]
-    for index, urlAndLink1 in enumerate(urlsAndLinks):
-        # TODO: some identical URL can be specified in different manners here
-        size = urlsAndLinks.count(urlAndLink1)
-        # remove duplicate dicts of the list
-        if size > 1:
-            for urlAndLink2 in urlsAndLinks:
-                if urlAndLink1[1]["page"] == urlAndLink2[1]["page"] and urlAndLink1[1]["method"] == urlAndLink2[1]["method"] and sorted(urlAndLink1[1]["params"]) == sorted(urlAndLink2[1]["params"]):
-                    urlsAndLinks.remove(urlAndLink2)
-        # define edge size
-        urlsAndLinks[index][1]["edgeSize"] = size+1
-    return urlsAndLinks
+    # keep the first occurrence of each edge, sized by its number of occurrences
+    firstUrlsAndLinks = {}
+    sizes = Counter()
+    for urlAndLink in urlsAndLinks:
+        key = edgeKey(urlAndLink[1])
+        if not(key in firstUrlsAndLinks):
+            firstUrlsAndLinks[key] = urlAndLink
+        sizes[key] += 1
+    # define edge size
+    for key, urlAndLink in firstUrlsAndLinks.items():
+        urlAndLink[1]["edgeSize"] = sizes[key] + 1
+    return list(firstUrlsAndLinks.values())
+
+# links of a node with one link per edge
+def globalLinks(links: []) -> []:
+    # the first link of an edge counts twice, then each other one adds its edgeSize - 1
+    newLinks = {}
+    for link in links:
+        key = edgeKey(link)
+        if key in newLinks:
+            newLinks[key]["edgeSize"] += link["edgeSize"] - 1
+        else:
+            newLinks[key] = {"page": link["page"], "params": link["params"], "method": link["method"], "edgeSize": 2 * link["edgeSize"] - 1}
+    return list(newLinks.values())
 
 def computeGlobalLinkSize(graph: {}) -> {}:
     for page, attributes in graph.items():
-        links = attributes["links"]
-        newLinks = []
-        alreadyAddedLinks = []
-        for link1 in links:
-            if (link1["page"], sorted(link1["params"]), link1["method"]) in alreadyAddedLinks:
-                continue
-            size = link1["edgeSize"]
-            for link2 in links:
-                if link1["page"] == link2["page"] and link1["method"] == link2["method"] and sorted(link1["params"]) == sorted(link2["params"]):
-                        size += link2["edgeSize"] - 1
-            alreadyAddedLinks.append((link1["page"], sorted(link1["params"]), link1["method"]))
-            newLinks.append({"page": link1["page"], "params": link1["params"], "method": link1["method"], "edgeSize": size})
-        graph[page]["links"] = newLinks
+        graph[page]["links"] = globalLinks(attributes["links"])
     return graph
 
 def colorNodes(graph: {}) -> {}:
@@ -135,9 +170,139 @@ def colorEdges(graph: {}, root: str) -> {}:
             graph[pageName]["links"][index]["color"] = color
     return graph
 
-def treefy(graph: nx.classes.multidigraph.MultiDiGraph, xCoef: int = 1, yCoef: int = 1) -> nx.classes.multidigraph.MultiDiGraph:
+## level of detail
+
+# node gathering the hosts beyond the maximum number of nodes
+otherHostsNode = "other hosts"
+# pages listed in the attributes of a cluster node
+maxListedPages = 100
+
+# hostname and first depth directories of the page, eg. "example.com/blog/" for "example.com/blog/2024/post.php" at depth 1
+# nodes which are not pages (eg. "recap") are their own cluster
+def clusterKey(page: str, depth: int) -> str:
+    parts = page.split('/')
+    if len(parts) < 2:
+        return page
+    directories = parts[1:-1][:depth]
+    return parts[0] + "/" + "".join(directory + "/" for directory in directories)
+
+# gathers the pages of the graph by hostname and directory prefix, keeping the deepest prefix giving at most maxNodes nodes
+# returns the graph of the clusters and the cluster of each page
+def clusterGraph(graph: {}, maxNodes: int = 500) -> ({}, {}):
+    # number of clusters for each depth
+    maxDirectories = max((page.count('/') - 1 for page in graph), default=0)
+    depth = 0
+    for candidate in range(1, maxDirectories + 1):
+        if len({clusterKey(page, candidate) for page in graph}) > maxNodes:
+            break
+        depth = candidate
+    clusters = {page: clusterKey(page, depth) for page in graph}
+
+    # too many hosts, the smallest ones are gathered
+    sizes = Counter()
+    for page, cluster in clusters.items():
+        sizes[cluster] += graph[page]["internal"]["nodeSize"]
+    if len(sizes) > maxNodes:
+        # nodes which are not pages are always kept
+        pageClusters = [cluster for cluster, size in sizes.most_common() if '/' in cluster]
+        kept = set(pageClusters[:max(maxNodes - (len(sizes) - len(pageClusters)) - 1, 0)])
+        for page, cluster in clusters.items():
+            if '/' in cluster and not(cluster in kept):
+                clusters[page] = otherHostsNode
+
+    # nodes with summed sizes, their attributes list their pages
+    clusterPages = {}
+    newGraph = {}
+    for page, attributes in graph.items():
+        cluster = clusters[page]
+        if not(cluster in newGraph):
+            newGraph[cluster] = {"links": [], "outOfScopeURLs": [], "internal": {"nodeSize": 0}}
+            clusterPages[cluster] = []
+        newGraph[cluster]["internal"]["nodeSize"] += attributes["internal"]["nodeSize"]
+        clusterPages[cluster].append(page)
+    for cluster, pages in clusterPages.items():
+        # a page alone keeps its own attributes
+        if pages == [cluster]:
+            newGraph[cluster]["outOfScopeURLs"] = graph[cluster]["outOfScopeURLs"]
+        else:
+            newGraph[cluster]["outOfScopeURLs"] = pages[:maxListedPages] + ([] if len(pages) <= maxListedPages else ["... " + str(len(pages) - maxListedPages) + " more pages"])
+
+    # edges between clusters with summed sizes, links inside a cluster are dropped
+    edges = {}
+    for page, attributes in graph.items():
+        for link in attributes["links"]:
+            source = clusters[page]
+            target = clusters.get(link["page"], link["page"])
+            if source == target:
+                continue
+            key = (source, target, link["method"])
+            if key in edges:
+                edges[key]["edgeSize"] += link["edgeSize"]
+                edges[key]["links"] += 1
+            else:
+                edges[key] = {"edgeSize": link["edgeSize"], "links": 1, "params": link["params"]}
+    for (source, target, method), edge in edges.items():
+        # a single link keeps its params, an aggregated one shows its number of links
+        newGraph[source]["links"].append({"page": target, "params": edge["params"] if edge["links"] == 1 else [str(edge["links"]) + " links"], "method": method, "edgeSize": edge["edgeSize"]})
+    return (newGraph, clusters)
+
+# breadth first tree of the graph, as the crawler visits it: the parent of a node is the first node linking to it
+# nodes unreachable from the root (eg. "recap") start their own tree
+# returns the nodes in breadth first order, with the index of their parent (-1 for a root) and their depth
+def bfsTree(graph: nx.classes.multidigraph.MultiDiGraph, root: str = None) -> ([], np.ndarray, np.ndarray):
+    index = {}
+    order = []
+    parents = []
+    depths = []
+    for start in ([root] if root in graph else []) + list(graph):
+        if start in index:
+            continue
+        index[start] = len(order)
+        order.append(start)
+        parents.append(-1)
+        depths.append(0)
+        position = len(order) - 1
+        while position < len(order):
+            node = order[position]
+            for successor in graph.adj[node]:
+                if not(successor in index):
+                    index[successor] = len(order)
+                    order.append(successor)
+                    parents.append(position)
+                    depths.append(depths[position] + 1)
+            position += 1
+    return (order, np.array(parents, dtype=np.int64), np.array(depths, dtype=np.int64))
+
+# layered tree layout: a depth per row, leaves side by side and each parent centered above its children
+# returns {node: (x, y)}, the root at the top as with graphviz dot
+def treeLayout(graph: nx.classes.multidigraph.MultiDiGraph, root: str = None) -> {}:
+    order, parents, depths = bfsTree(graph, root)
+    if order == []:
+        return {}
+    levels = [np.flatnonzero(depths == depth) for depth in range(depths.max() + 1)]
+    # number of leaves under each node, from the deepest level to the roots
+    hasChild = np.zeros(len(order), dtype=bool)
+    hasChild[parents[parents >= 0]] = True
+    widths = np.where(hasChild, 0, 1)
+    for level in reversed(levels[1:]):
+        np.add.at(widths, parents[level], widths[level])
+    # left side of each node, children of a same parent are contiguous in breadth first order
+    starts = np.zeros(len(order), dtype=np.int64)
+    starts[levels[0]] = np.cumsum(widths[levels[0]]) - widths[levels[0]]
+    for level in levels[1:]:
+        offsets = np.cumsum(widths[level]) - widths[level]
+        levelParents = parents[level]
+        # offset of the first child of the parent of each node
+        firstChildren = np.r_[True, levelParents[1:] != levelParents[:-1]]
+        groupOffsets = offsets[np.flatnonzero(firstChildren)][np.cumsum(firstChildren) - 1]
+        starts[level] = starts[levelParents] + offsets - groupOffsets
+    xs = (starts + widths / 2) * treeNodeGap
+    ys = (depths.max() - depths) * treeLevelGap
+    return dict(zip(order, zip(xs.tolist(), ys.tolist())))
+
+def treefy(graph: nx.classes.multidigraph.MultiDiGraph, xCoef: int = 1, yCoef: int = 1, root: str = None) -> nx.classes.multidigraph.MultiDiGraph:
     # calculate layout to have a tree graph
-    pos = graphviz_layout(graph, prog='dot')
+    pos = treeLayout(graph, root)
     # add node positions as attributes
     for name, (x, y) in pos.items():
         node = graph.nodes[name]
@@ -148,31 +313,17 @@ def treefy(graph: nx.classes.multidigraph.MultiDiGraph, xCoef: int = 1, yCoef: i
 
 def makeNXGraph(graph: {}) -> nx.classes.multidigraph.MultiDiGraph:
     g = nx.MultiDiGraph()
-    for page, linksAndProps in graph.items():
-        # add starting nodes
-        g.add_node(page, size=(10*log(graph[page]["internal"]["nodeSize"])), color=graph[page]["internal"]["color"])
-        # add edges
-        for key, reqss in linksAndProps.items():
-            if(key == "links"):
-                for reqs in reqss:
-                    g.add_edge(page, reqs["page"], size=log(reqs["edgeSize"]), color=reqs["color"], label='\n'.join(reqs["params"]))
-        # add attributes
-        nx.set_node_attributes(g, {page: {"click": '\n'.join(linksAndProps["outOfScopeURLs"])}})
-        previousPage = ""
-        for link in linksAndProps["links"]:
-            if previousPage != link["page"]:
-                index = 0
-            nx.set_edge_attributes(g, {(page, link["page"], index): {"click": "" if link["params"] == [] else '\n'.join(link["params"])}})
-            index += 1
-            previousPage = link["page"]
-    
+    # nodes and edges are added at once with their attributes
+    g.add_nodes_from((page, {"size": 10*log(linksAndProps["internal"]["nodeSize"]), "color": linksAndProps["internal"]["color"], "click": '\n'.join(linksAndProps["outOfScopeURLs"])}) for page, linksAndProps in graph.items())
+    g.add_edges_from((page, link["page"], {"size": log(link["edgeSize"]), "color": link["color"], "label": '\n'.join(link["params"]), "click": '\n'.join(link["params"])}) for page, linksAndProps in graph.items() for link in linksAndProps["links"])
+
     g.nodes["recap"]["x"] = -300
     g.nodes["recap"]["y"] = 300
     return g
 
-def drawGravis(graph: nx.classes.multidigraph.MultiDiGraph, dim: int = 2, tree: bool = False, xCoef: int = 1, yCoef: int = 1) -> None:
+def drawGravis(graph: nx.classes.multidigraph.MultiDiGraph, dim: int = 2, tree: bool = False, xCoef: int = 1, yCoef: int = 1, root: str = None) -> None:
     if tree:
-        graph = treefy(graph, xCoef, yCoef)
+        graph = treefy(graph, xCoef, yCoef, root)
     if dim == 2:
         g = gv.d3(graph, show_node_label=True, show_edge_label=True, edge_label_data_source='label', node_drag_fix=True, layout_algorithm_active=True, graph_height=500, details_height=200, show_details=True, show_menu=True, edge_curvature=0.2)
     else:
@@ -180,26 +331,102 @@ def drawGravis(graph: nx.classes.multidigraph.MultiDiGraph, dim: int = 2, tree:
 
     g.display()
 
-## misc
+## fetching
 
-def printVerb(verbosity: bool, color: str = 'N', message: str = "") -> None:
-    if verbosity:
-        if color == 'G':
-            print(Fore.GREEN + message)
-        elif color == 'Y':
-            print(Fore.YELLOW + message)
-        elif color == 'R':
-            print(Fore.RED + message)
-        elif color == 'W':
-            print(Fore.WHITE + message)
-        else:
-            print(Fore.RESET + message)
+class SkippedPage(Exception):
+    """Exception raised for a response which is not a page (eg. image, archive, video), whose body is not downloaded"""
+
+def isHtml(headers: object) -> bool:
+    contentType = headers.get("Content-Type")
+    return contentType == None or contentType.split(";")[0].strip().lower() in htmlTypes
 
-def doRequest(url: str, cookies: [] = []) -> str:
+# reads the body of the http.client response (also returned by urlopen) as it arrives, decompressed (gzip, deflate) and cut at maxPageSize,
+# None if the response is not a page, which is then left unread (to close) unless it is small
+def readPage(response: object) -> bytes:
+    if not(isHtml(response.headers)):
+        metrics.registry.count("sidemap_skipped_pages_total")
+        if response.length != None and response.length <= drainSize:
+            metrics.registry.count("sidemap_transferred_bytes_total", len(response.read()))
+        return None
+
+    encoding = (response.headers.get("Content-Encoding") or "identity").strip().lower()
+    # gzip or zlib header detected, raw deflate tried on failure
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32) if encoding in ("gzip", "x-gzip", "deflate") else None
+    chunks = []
+    size = 0
+    transferred = 0
+    while size < maxPageSize:
+        chunk = response.read(readChunkSize)
+        if chunk == b"":
+            break
+        transferred += len(chunk)
+        if decompressor != None:
+            try:
+                chunk = decompressor.decompress(chunk, maxPageSize - size)
+            except zlib.error:
+                if encoding != "deflate" or size > 0:
+                    raise
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                chunk = decompressor.decompress(chunk, maxPageSize - size)
+        chunks.append(chunk)
+        size += len(chunk)
+    if decompressor != None and size < maxPageSize:
+        chunks.append(decompressor.flush())
+    metrics.registry.count("sidemap_transferred_bytes_total", transferred)
+    if size >= maxPageSize:
+        metrics.registry.count("sidemap_truncated_pages_total")
+    return b"".join(chunks)[:maxPageSize]
+
+# code of the page, decoded with the charset of its Content-Type, or of its <meta> tags, UTF-8 by default
+def decodePage(body: bytes, headers: object) -> str:
+    charset = headers.get_content_charset() if hasattr(headers, "get_content_charset") else None
+    if charset == None:
+        match = metaCharsetRegex.search(body[:2048])
+        charset = match.group(1).decode("ascii") if match != None else "utf-8"
+    try:
+        return body.decode(charset, errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
+
+# validators: cache.PageValidators of the crawl, makes the request conditional and records the response
+# an unmodified page (304) returns an empty code, its requests are in the validators, and a response which is not a page raises SkippedPage
+def doRequest(url: str, cookies: [] = [], validators = None) -> str:
     req = Request(url)
     req.add_header('User-Agent', userAgent)
     req.add_header('Cookie', "; ".join(cookies))
-    return(urlopen(req).read().decode('utf-8'))
+    req.add_header('Accept-Encoding', "gzip, deflate")
+    if validators != None:
+        for name, value in validators.conditionalHeaders(url).items():
+            req.add_header(name, value)
+
+    def send() -> (int, {}, bytes):
+        with urlopen(req, timeout=ratecontrol.controller.timeout) as response:
+            return (response.status, response.headers, readPage(response))
+
+    start = time.perf_counter()
+    try:
+        # scheduled, and retried if throttled or failed, by the rate controller of the host
+        status, responseHeaders, body = ratecontrol.controller.call(urlsplit(url).netloc, send)
+        pageCode = None if body == None else decodePage(body, responseHeaders)
+    except HTTPError as e:
+        metrics.registry.observe("sidemap_fetch_seconds", time.perf_counter() - start)
+        metrics.registry.count("sidemap_responses_total", status=e.code)
+        if validators != None and e.code == 304:
+            validators.update(url, e.code, e.headers, b"")
+            return ""
+        raise
+    except:
+        metrics.registry.observe("sidemap_fetch_seconds", time.perf_counter() - start)
+        metrics.registry.count("sidemap_fetch_errors_total")
+        raise
+    metrics.registry.observe("sidemap_fetch_seconds", time.perf_counter() - start)
+    metrics.registry.count("sidemap_responses_total", status=status)
+    if body == None:
+        raise SkippedPage(url + " is not a page (" + str(responseHeaders.get("Content-Type")) + ")")
+    metrics.registry.observe("sidemap_response_bytes", len(body))
+    if validators != None:
+        validators.update(url, status, responseHeaders, body)
+    return pageCode
 
 def getStatusCode(url: str) -> int:
     try:
@@ -208,6 +435,21 @@ def getStatusCode(url: str) -> int:
         code = e.code
     return code
 
+## misc
+
+def printVerb(verbosity: bool, color: str = 'N', message: str = "") -> None:
+    if verbosity:
+        if color == 'G':
+            print(Fore.GREEN + message, file=verboseStream)
+        elif color == 'Y':
+            print(Fore.YELLOW + message, file=verboseStream)
+        elif color == 'R':
+            print(Fore.RED + message, file=verboseStream)
+        elif color == 'W':
+            print(Fore.WHITE + message, file=verboseStream)
+        else:
+            print(Fore.RESET + message, file=verboseStream)
+
 def isInScope(refDomain: str, domain: str) -> bool:
     return re.match("(\.|^)"+refDomain, domain)
 